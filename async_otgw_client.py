@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import time
+from otgw import OTGW
+from line_framer import LineFramer
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+
+class AsyncOTGWClient:
+
+    # reads straight into one preallocated buffer (recv_into) instead of a new bytes object per read
+    class Protocol(asyncio.BufferedProtocol):
+
+        def __init__(self, client, readSize):
+            self.__client = client
+            self.__framer = LineFramer()
+            self.__buffer = memoryview(bytearray(readSize))
+
+        def connection_made(self, transport):
+            self.__client._connection_made(transport)
+
+        def get_buffer(self, sizehint):
+            return self.__buffer
+
+        def buffer_updated(self, nbytes):
+            self.__client._read(nbytes)
+            for line in self.__framer.feed(self.__buffer[:nbytes]):
+                self.__client._process_line(line)
+
+        def connection_lost(self, exc):
+            self.__client._connection_lost(exc)
+
+    defaultReadSize = 4096
+
+    def __init__(self, host, port, on_message=None, timeout=5, name="otgw", readSize=defaultReadSize):
+        self.__host = host
+        self.__port = port
+        self.__timeout = timeout
+        self.__readSize = readSize
+        self.__on_message = on_message
+        self.__otgw = OTGW(name)
+        self.__connects = 0
+        self.__reconnects = registry.counter("otgw_reconnects_total", "Gateway connections re-established", gateway=name)
+        self.__connected = registry.gauge("otgw_connected", "1 while the gateway connection is up", gateway=name)
+        self.__recvCalls = registry.counter("otgw_recv_calls_total", "Socket reads from the gateway", gateway=name)
+        self.__recvBytes = registry.counter("otgw_recv_bytes_total", "Bytes read from the gateway", gateway=name)
+        self.__transport = None
+        self.__closed = None
+        self.__pending = {}
+        self.__legTimer = None
+        self.__commandTimer = None
+        self.__running = False
+        self.__stopped = None
+        self.lastData = 0
+        self.__statsStart = time.time()
+        self.__statsCalls = 0
+        self.__statsBytes = 0
+
+    async def run(self):
+        if self.__running:
+            raise RuntimeError("Already running")
+        self.__running = True
+        loop = asyncio.get_running_loop()
+        self.__stopped = loop.create_future()
+        while self.__running:
+            try:
+                log.info("Connecting to {}:{}".format(self.__host, self.__port))
+                await self.__unless_stopped(asyncio.wait_for(
+                    loop.create_connection(lambda: self.Protocol(self, self.__readSize), self.__host, self.__port),
+                    self.__timeout))
+            except (OSError, asyncio.TimeoutError) as e:
+                log.error("Exception while connecting ({}). Sleep {} sec and retry".format(e, self.__timeout))
+                await self.__unless_stopped(asyncio.sleep(self.__timeout))
+                continue
+            if self.__transport:
+                await self.__watch_connection()
+
+    # connecting and the retry sleep are cut short by stop(), whatever they were waiting for is cancelled
+    async def __unless_stopped(self, awaitable):
+        task = asyncio.ensure_future(awaitable)
+        await asyncio.wait((task, self.__stopped), return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            return task.result()
+        task.cancel()
+        await asyncio.wait((task,))
+
+    async def __watch_connection(self):
+        # wakes up when no data arrived for the timeout, commands are driven by their own timer;
+        # stop() closes the transport, which ends the watch like any other lost connection
+        while True:
+            silence = time.time() - self.lastData
+            if silence <= self.__timeout:
+                try:
+                    await asyncio.wait_for(asyncio.shield(self.__closed), self.__timeout - silence + 0.01)
+                except asyncio.TimeoutError:
+                    continue
+                break
+            log.warning("Data timeout reconnecting")
+            self.__transport.close()
+            await self.__closed
+            break
+
+    def stop(self):
+        self.__running = False
+        if self.__stopped and not self.__stopped.done():
+            self.__stopped.set_result(None)
+        if self.__transport:
+            self.__transport.close()
+
+    async def send_command(self, command, priority=None, maxAge=None):
+        return await self.submit_command(command, priority, maxAge)
+
+    # queues a command from inside the event loop, the future resolves with the processed command;
+    # one dropped by the scheduler (superseded, expired, ...) resolves unsuccessful with that result
+    def submit_command(self, command, priority=None, maxAge=None):
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[self.__otgw.send_command(command, priority, maxAge)] = future
+        self.__dispatch_commands()
+        return future
+
+    @property
+    def recvCalls(self):
+        return self.__recvCalls.value
+
+    @property
+    def recvBytes(self):
+        return self.__recvBytes.value
+
+    def stats(self):
+        now = time.time()
+        calls = self.recvCalls - self.__statsCalls
+        size = self.recvBytes - self.__statsBytes
+        elapsed = now - self.__statsStart
+        self.__statsStart, self.__statsCalls, self.__statsBytes = now, self.recvCalls, self.recvBytes
+        return {
+            "syscalls_per_second": calls / elapsed if elapsed > 0 else 0.0,
+            "bytes_per_syscall": size / calls if calls else 0.0,
+        }
+
+    def _connection_made(self, transport):
+        if not self.__running:
+            # stop() came while the connection was being set up
+            transport.close()
+            return
+        log.info("Connected to {}:{}".format(self.__host, self.__port))
+        self.__connects += 1
+        if self.__connects > 1:
+            self.__reconnects.inc()
+        self.__connected.set(1)
+        self.__transport = transport
+        self.__closed = asyncio.get_running_loop().create_future()
+        self.lastData = time.time()
+        self.__dispatch_commands()
+
+    def _connection_lost(self, exc):
+        if exc:
+            log.warning("Connection lost ({})".format(exc))
+        self.__transport = None
+        command = self.__otgw.lastCommand
+        if command:
+            # its response is lost with the connection, it goes out again after reconnecting
+            command.sent = False
+        # queued commands still run into their deadlines while disconnected
+        self.__dispatch_commands()
+        self.__connected.set(0)
+        if self.__closed and not self.__closed.done():
+            self.__closed.set_result(None)
+
+    def _read(self, nbytes):
+        self.__recvCalls.inc()
+        self.__recvBytes.inc(nbytes)
+
+    def _process_line(self, line):
+        self.lastData = time.time()
+        operation = self.__otgw.processLine(line)
+        if isinstance(operation, OTGW.Message):
+            self.__deliver(operation)
+        elif isinstance(operation, OTGW.Command):
+            self.__on_command(operation)
+        if self.__legTimer is None:
+            self.__schedule_leg_timer()
+
+    def __schedule_leg_timer(self):
+        deadline = self.__otgw.messageDeadline()
+        if deadline is not None:
+            self.__legTimer = asyncio.get_running_loop().call_later(deadline, self.__expire_message)
+
+    def __expire_message(self):
+        self.__legTimer = None
+        message = self.__otgw.expireMessage()
+        if message:
+            self.__deliver(message)
+        self.__schedule_leg_timer()
+
+    def __deliver(self, message):
+        if self.__on_message:
+            try:
+                self.__on_message(message)
+            except Exception as e:
+                log.warning(str(e))
+
+    # writes the next command when the gateway is idle, resolves dropped ones and arms the
+    # timer for the next ack timeout, retry backoff or command deadline
+    def __dispatch_commands(self):
+        self.__cancel_command_timer()
+        if self.__transport:
+            command = self.__otgw.pollCommand()
+            if command:
+                log.info("Sending command: '{}'".format(command.command))
+                self.__transport.write("{}\r".format(command.command).encode())
+                command.written(time.time())
+        for command in self.__otgw.takeDroppedCommands():
+            self.__resolve(command)
+        deadline = self.__otgw.commandDeadline()
+        if deadline is not None:
+            self.__commandTimer = asyncio.get_running_loop().call_later(deadline, self.__expire_command)
+
+    def __expire_command(self):
+        self.__commandTimer = None
+        self.__otgw.expireCommand()
+        self.__dispatch_commands()
+
+    def __cancel_command_timer(self):
+        if self.__commandTimer:
+            self.__commandTimer.cancel()
+            self.__commandTimer = None
+
+    def __resolve(self, command):
+        future = self.__pending.pop(command, None)
+        if future and not future.done():
+            future.set_result(command)
+
+    def __on_command(self, command):
+        if command.processed:
+            log.info("Processed command: {}".format(command))
+            self.__resolve(command)
+        # the gateway handles one command at a time, the next one can go out now
+        self.__dispatch_commands()
@@ -0,0 +1,1329 @@
+import asyncio
+import contextlib
+import gc
+import json
+import logging
+import multiprocessing
+import random
+import re
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+from otgw import OTGW
+from line_framer import LineFramer
+from otgw_simulator import OTGWSimulator
+from async_otgw_client import AsyncOTGWClient
+from mqtt_publisher import BatchPublisher
+
+testData = 'test-data/baxi-roca.txt'
+
+
+def load_lines(path=testData):
+    with open(path) as f:
+        return [line.rstrip('\r\n') for line in f]
+
+
+def measure(fn, lines, repeat=50):
+    best = None
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for line in lines:
+                fn(line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None or elapsed < best else best
+    return best / (repeat * len(lines))
+
+
+# the regex based parser that OTGW.Message.processLine used before decodeFrame
+legacyParser = re.compile(r'^(?P<source>[BART])(?P<type>[0-9A-F])(?P<res>[0-9A-F])(?P<id>[0-9A-F]{2})(?P<data>[0-9A-F]{4})$')
+
+
+def legacy_hex_int(hex):
+    return int(hex, 16)
+
+
+def legacy_decode(line):
+    info = legacyParser.match(line)
+    if info is None:
+        return None
+    (src, msgType, nop, dataId, data) = map(lambda f, d: f(d),
+        (str, lambda _: legacy_hex_int(_) & 7, legacy_hex_int, legacy_hex_int, legacy_hex_int),
+        info.groups())
+    return (src, msgType, dataId, data)
+
+
+def legacy_message_line(line):
+    frame = legacy_decode(line)
+    if frame is not None:
+        OTGW.Message.MessageLine(line, *frame)
+
+
+def table_message_line(line):
+    frame = OTGW.Message.decodeFrame(line)
+    if frame is not None:
+        OTGW.Message.MessageLine(line, *frame)
+
+
+def bench_decoder():
+    lines = load_lines()
+    # gateway noise the regex rejects
+    noise = ["T0X000000", "B0x1A2B3C", "T4000 000", "T+0000001", "Ta0000000", "T4_000000", "R\u0664\u0664\u0664\u0664\u0664\u0664\u0664\u0664"]
+    for line in lines + noise:
+        if legacy_decode(line) != OTGW.Message.decodeFrame(line):
+            raise AssertionError("Decoder mismatch for '{}'".format(line))
+    results = [
+        ("regex decode", measure(legacy_decode, lines)),
+        ("table decode", measure(OTGW.Message.decodeFrame, lines)),
+        ("regex decode + MessageLine", measure(legacy_message_line, lines)),
+        ("table decode + MessageLine", measure(table_message_line, lines)),
+    ]
+    for name, perLine in results:
+        print("{:<30} {:8.0f} ns/line".format(name, perLine * 1e9))
+
+
+# the twelve id table MessageLine had before the data id schema
+legacyDataIdTable = [("Unknown", lambda val: val)] * 256
+for _dataId, _name in ((1, "control_setpoint"), (9, "remote_override_setpoint"), (16, "room_setpoint"),
+                       (18, "ch_water_pressure"), (24, "room_temperature"), (25, "boiler_water_temperature"),
+                       (26, "dhw_temperature"), (27, "outside_temperature"), (28, "return_water_temperature"),
+                       (56, "dhw_setpoint"), (57, "max_ch_water_setpoint")):
+    legacyDataIdTable[_dataId] = (_name, lambda val: round(val / float(256), 2))
+legacyDataIdTable[0] = ("status", lambda val: "{0:b}".format(val))
+del _dataId, _name
+
+
+def convert_with(table):
+    def convert(frame):
+        name, converter = table[frame[2]]
+        return converter(frame[3])
+    return convert
+
+
+def bench_schema():
+    # the capture only uses a few ids and payloads, the synthetic frames cycle through every id of
+    # the schema and the last set never repeats a payload within an id
+    captured = [frame for frame in map(OTGW.Message.decodeFrame, load_lines()) if frame]
+    ids = sorted(OTGW.Message.MessageLine.openthermIds)
+    synthetic = [('B', 4, dataId, (dataId * 2654435761) & 0xFFFF) for dataId in ids]
+    distinct = [('B', 4, ids[i % len(ids)], i & 0xFFFF) for i in range(len(ids) * 256)]
+    for name, frames in (("captured", captured), ("every schema id", synthetic), ("distinct payloads", distinct)):
+        legacy = measure(convert_with(legacyDataIdTable), frames, 200)
+        schema = measure(convert_with(OTGW.Message.MessageLine.dataIdTable), frames, 200)
+        line = measure(lambda frame: OTGW.Message.MessageLine(None, *frame), frames, 200)
+        print("{:<17} legacy table {:5.0f} ns/frame, schema {:5.0f} ns/frame, schema MessageLine {:5.0f} ns/frame".format(
+            name, legacy * 1e9, schema * 1e9, line * 1e9))
+
+
+def legacy_status_topics(topic, value):
+    # the bridge's status translation before bit masks: a binary string reversed and indexed per bit
+    def extractBit(value, number):
+        rev = value[::-1]
+        try:
+            return str(rev[number] == "1")
+        except:
+            return str(False)
+    return [
+        ("status", "{}/fault".format(topic), extractBit(value, 0)),
+        ("status", "{}/ch_active".format(topic), extractBit(value, 1)),
+        ("status", "{}/dhw_active".format(topic), extractBit(value, 2)),
+        ("status", "{}/flame".format(topic), extractBit(value, 3)),
+    ]
+
+
+def bench_status():
+    from otgw_bridge import OTGWBridge
+    logging.disable(logging.WARNING)
+    config = {
+        "otgw": {"host": "127.0.0.1", "port": 0},
+        "mqtt": {"host": "127.0.0.1", "port": 1883, "username": None, "password": None,
+                 "value_topic_namespace": "value/otgw", "set_topic_namespace": "set/otgw",
+                 "qos": 0, "retain": False},
+    }
+    bridge = OTGWBridge(config)
+    gateway = bridge._OTGWBridge__gateways[0]
+    translate = bridge._OTGWBridge__otgw_translate_message
+    otgw = OTGW()
+    message = None
+    for line in ("T00000300", "B40000302"):
+        message = otgw.processLine(line)
+    flags = "{0:b}".format(message.boilerSrc.data)
+    legacy = measure(lambda _: legacy_status_topics("value/otgw/status", flags), [None], 100000)
+    masks = measure(lambda _: list(translate(gateway, message)), [None], 100000)
+    print("string bits, 4 topics   {:6.0f} ns/status frame".format(legacy * 1e9))
+    print("bit masks, {} topics    {:6.0f} ns/status frame".format(len(gateway.statusTopics), masks * 1e9))
+
+
+class LegacyMessageLine:
+    # per-instance __dict__ layout MessageLine had before __slots__
+    def __init__(self, line, src, msgType, dataId, data):
+        self.line = line.rstrip()
+        self.src = src
+        self.msgType = msgType
+        self.dataId = dataId
+        self.data = data
+        self.msgTypeName = OTGW.Message.MessageLine.openthermTypes[msgType]
+        self.dataIdName, converter = OTGW.Message.MessageLine.dataIdTable[dataId]
+        self.value = converter(data)
+
+
+class LegacyMessage:
+    # class attributes shadowed per instance, as Message had before __slots__
+    dataId = None
+    thermostatSrc = None
+    boilerDst = None
+    boilerSrc = None
+    thermostatDst = None
+    srcValue = None
+    dstValue = None
+    ready = False
+    msg = None
+
+    def processLine(self, msgLine):
+        frame = OTGW.Message.decodeFrame(msgLine)
+        if frame is None:
+            return False
+        messageLine = LegacyMessageLine(msgLine, *frame)
+        if self.dataId != None and self.dataId != messageLine.dataId:
+            self.ready = True
+            if self.thermostatSrc and self.thermostatSrc.dataIdName != "Unknown":
+                self.msg = self.thermostatSrc.dataIdName
+            return False
+        self.dataId = messageLine.dataId
+        if messageLine.src == 'T':
+            self.thermostatSrc = messageLine
+        elif messageLine.src == 'R':
+            self.boilerDst = messageLine
+        elif messageLine.src == 'B':
+            self.boilerSrc = messageLine
+        elif messageLine.src == 'A':
+            self.thermostatDst = messageLine
+        return True
+
+
+def assemble_messages(messageClass, lines):
+    messages = []
+    lastMessage = messageClass()
+    for line in lines:
+        lastMessage.processLine(line)
+        if lastMessage.ready:
+            messages.append(lastMessage)
+            lastMessage = messageClass()
+            lastMessage.processLine(line)
+    return messages
+
+
+def retained_bytes_per_message(messageClass, lines):
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    messages = assemble_messages(messageClass, lines)
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return retained / len(messages), len(messages)
+
+
+def bench_memory():
+    # copy the lines so every decoded message owns its raw text like a socket read would
+    lines = [line + "\n" for line in load_lines()] * 20
+    messageLine = OTGW.Message.MessageLine
+    results = [("dict Message/MessageLine", retained_bytes_per_message(LegacyMessage, lines))]
+    messageLine.keepLine = True
+    results.append(("slots, keepLine=True", retained_bytes_per_message(OTGW.Message, lines)))
+    messageLine.keepLine = False
+    results.append(("slots, keepLine=False", retained_bytes_per_message(OTGW.Message, lines)))
+    for name, (perMessage, count) in results:
+        print("{:<30} {:8.0f} bytes/message ({} messages)".format(name, perMessage, count))
+
+
+def timestamped_lines(lines, interval=1.0, legGap=0.1):
+    # a transaction every `interval` seconds, its R/B/A legs `legGap` apart
+    stamped = []
+    start = -interval
+    for line in lines:
+        if line[:1] == 'T':
+            start += interval
+            now = start
+        else:
+            now += legGap
+        stamped.append((now, line))
+    return stamped
+
+
+def legacy_emit_latencies(stamped):
+    latencies = []
+    lastMessage = LegacyMessage()
+    lastLeg = None
+    for now, line in stamped:
+        lastMessage.processLine(line)
+        if lastMessage.ready:
+            if lastMessage.thermostatSrc:
+                latencies.append(now - lastLeg)
+            lastMessage = LegacyMessage()
+            lastMessage.processLine(line)
+        lastLeg = now
+    return latencies
+
+
+def completion_emit_latencies(stamped):
+    clock = [0.0]
+    otgw = OTGW()
+    otgw.clock = lambda: clock[0]
+    latencies = []
+    lastLeg = None
+    for now, line in stamped:
+        deadline = otgw.messageDeadline()
+        if deadline is not None and clock[0] + deadline <= now:
+            # the leg timer of the client fires before the next frame arrives
+            clock[0] += deadline
+            if otgw.expireMessage():
+                latencies.append(clock[0] - lastLeg)
+        clock[0] = now
+        if isinstance(otgw.processLine(line), OTGW.Message):
+            latencies.append(now - lastLeg if otgw.lastMessage.updated == now else 0.0)
+        lastLeg = now
+    return latencies
+
+
+def message_legs(message):
+    return tuple(leg and (leg.src, leg.msgType, leg.dataId, leg.data)
+                 for leg in (message.thermostatSrc, message.boilerDst, message.boilerSrc, message.thermostatDst))
+
+
+def completion_messages(lines):
+    otgw = OTGW()
+    messages = [otgw.processLine(line) for line in lines]
+    otgw.clock = lambda: float("inf")
+    messages.append(otgw.expireMessage())
+    return [message for message in messages if isinstance(message, OTGW.Message)]
+
+
+def bench_assembly():
+    # the capture has no transaction where the gateway substitutes only the answer, so add
+    # T-B-A (remote override), T-R-B-A, T-B and an unknown id around it
+    extra = ["T00090000", "B40090000", "A40091400", "T10010000", "R10012800", "B50012800", "A50012800",
+             "T00190000", "B40192D00", "T00090000", "B40090000", "A40090000", "T00460000", "B70460000",
+             "A40460000", "T001B0000", "B401B0500", "T00190000", "B40192D00"]
+    lines = [line for line in load_lines() if line[:1] in "TBRA"] + extra
+    legacy = [message_legs(message) for message in assemble_messages(LegacyMessage, lines)]
+    legacy.append(message_legs(assemble_messages(LegacyMessage, lines + ["T00000000"])[-1]))
+    if legacy != [message_legs(message) for message in completion_messages(lines)]:
+        raise AssertionError("Completion assembly differs from assembly on the next data id")
+    stamped = timestamped_lines(lines)
+    for name, latencies in (("emit on next data id", legacy_emit_latencies(stamped)),
+                            ("emit on completion", completion_emit_latencies(stamped))):
+        latencies.sort()
+        print("{:<22} {:5} messages  p50 {:6.0f} ms  p99 {:6.0f} ms  max {:6.0f} ms".format(
+            name, len(latencies), percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+            latencies[-1] * 1000))
+
+
+def legacy_frame(chunks):
+    # str buffer re-sliced after every line, as OTGWBridge.__otgw_worker did before LineFramer
+    line_regex = re.compile(r'^.*[\r\n]+')
+    buffer = ""
+    count = 0
+    for chunk in chunks:
+        buffer += chunk.decode()
+        while True:
+            m = line_regex.match(buffer)
+            if not m:
+                break
+            m.group().rstrip('\r\n')
+            count += 1
+            buffer = buffer[m.end():]
+    return count
+
+
+def framer_frame(chunks):
+    framer = LineFramer()
+    count = 0
+    for chunk in chunks:
+        count += len(framer.feed(chunk))
+    return count
+
+
+def replay_bytes(size):
+    with open(testData, 'rb') as f:
+        data = f.read().replace(b'\n', b'\r\n')
+    return (data * (size // len(data) + 1))[:size]
+
+
+def bench_framing():
+    for size, chunkSize, legacy in ((4 << 20, 11, True), (4 << 20, 4096, False), (256 << 10, 4096, True), (4 << 20, 65536, False)):
+        data = replay_bytes(size)
+        chunks = [data[i:i + chunkSize] for i in range(0, len(data), chunkSize)]
+        runs = [("LineFramer", framer_frame)]
+        if legacy:
+            runs.insert(0, ("str regex buffer", legacy_frame))
+        for name, fn in runs:
+            start = time.perf_counter()
+            lines = fn(chunks)
+            elapsed = time.perf_counter() - start
+            print("{:<18} {:>5} KiB replay, {:>5} byte chunks: {:8.1f} MiB/s ({} lines)".format(
+                name, size >> 10, chunkSize, size / elapsed / (1 << 20), lines))
+
+
+def simulated_gateways(portsQueue, count, rate):
+    async def serve():
+        simulators = [await OTGWSimulator(rate=rate, replay=testData).start() for _ in range(count)]
+        portsQueue.put([simulator.port for simulator in simulators])
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def bench_gateways(counts=(1, 10, 50), rate=20, duration=5):
+    from otgw_bridge import OTGWBridge
+    logging.disable(logging.WARNING)
+    for count in counts:
+        portsQueue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=simulated_gateways, args=(portsQueue, count, rate), daemon=True)
+        server.start()
+        ports = portsQueue.get()
+        config = {
+            "gateways": [{"name": "gw{}".format(i), "host": "127.0.0.1", "port": port} for i, port in enumerate(ports)],
+            # the broker is never connected, publish() stops at the socket check
+            "mqtt": {"host": "127.0.0.1", "port": 1883, "username": None, "password": None,
+                     "value_topic_namespace": "value/otgw", "set_topic_namespace": "set/otgw",
+                     "qos": 0, "retain": False},
+        }
+        gc.collect()
+        tracemalloc.start()
+        bridge = OTGWBridge(config)
+        bridge.start_gateways()
+        time.sleep(2)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        cpuStart, wallStart = time.process_time(), time.perf_counter()
+        time.sleep(duration)
+        cpu = (time.process_time() - cpuStart) / (time.perf_counter() - wallStart)
+        bridge.stop_gateways()
+        server.terminate()
+        server.join()
+        print("{:>3} gateways at {} lines/s: {:6.2f} % CPU/gateway, {:7.1f} KiB/gateway".format(
+            count, rate, cpu * 100 / count, memory / 1024 / count))
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+@contextlib.contextmanager
+def command_suppression(enabled):
+    # OTGW.suppressUnchanged for one benchmark; the command benchmarks repeat setpoints that
+    # would otherwise be answered from the decoded state
+    saved = OTGW.suppressUnchanged
+    OTGW.suppressUnchanged = enabled
+    try:
+        yield
+    finally:
+        OTGW.suppressUnchanged = saved
+
+
+@command_suppression(False)
+def bench_commands(count=200):
+    logging.disable(logging.WARNING)
+
+    async def run():
+        for name, rate in (("idle", 0), ("busy", 2000)):
+            simulator = await OTGWSimulator(rate=rate).start()
+            messages = []
+            client = AsyncOTGWClient(simulator.host, simulator.port, on_message=messages.append)
+            task = asyncio.ensure_future(client.run())
+            await client.send_command("TT=20")
+            latencies = []
+            start = time.perf_counter()
+            for i in range(count):
+                sent = time.perf_counter()
+                await client.send_command("TT={}".format(15 + i % 10))
+                latencies.append(time.perf_counter() - sent)
+            elapsed = time.perf_counter() - start
+            print("{} gateway: command round trip p50 {:.2f} ms, p99 {:.2f} ms, {:.0f} commands/s, {} messages decoded".format(
+                name, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, count / elapsed, len(messages)))
+            for _ in range(5):
+                simulator.disconnect()
+                while simulator.disconnectedAt is not None:
+                    await asyncio.sleep(0.001)
+            print("{} gateway: reconnect p50 {:.2f} ms".format(name, percentile(simulator.reconnectTimes, 0.5) * 1000))
+            client.stop()
+            await task
+            simulator.close()
+
+    asyncio.run(run())
+
+
+@command_suppression(False)
+def bench_dispatch(count=200, drops=3):
+    # commands are submitted from another thread like the MQTT callback does, the latency
+    # runs until the simulated gateway reads the command line
+    logging.disable(logging.WARNING)
+    loop = run_loop_in_thread()
+
+    def wait_for(condition, timeout=10):
+        end = time.perf_counter() + timeout
+        while not condition():
+            if time.perf_counter() > end:
+                raise AssertionError("Timed out")
+            time.sleep(0.0001)
+
+    for name, rate in (("idle", 0), ("busy", 2000)):
+        simulator = asyncio.run_coroutine_threadsafe(OTGWSimulator(rate=rate).start(), loop).result()
+        client = AsyncOTGWClient(simulator.host, simulator.port)
+        task = asyncio.run_coroutine_threadsafe(client.run(), loop)
+        asyncio.run_coroutine_threadsafe(client.send_command("TT=20"), loop).result(10)
+        latencies = []
+        for i in range(count):
+            received = len(simulator.commandTimes)
+            submitted = time.perf_counter()
+            loop.call_soon_threadsafe(client.submit_command, "TT={}".format(15 + i % 10))
+            wait_for(lambda: len(simulator.commandTimes) > received)
+            latencies.append(simulator.commandTimes[-1] - submitted)
+            # let the response arrive so the next command does not queue behind this one
+            time.sleep(0.002)
+        print("{} gateway: set -> gateway write p50 {:.2f} ms, p99 {:.2f} ms".format(
+            name, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+        resends = []
+        for _ in range(drops):
+            received = len(simulator.commandTimes)
+            simulator.dropRate = 1.0
+            loop.call_soon_threadsafe(client.submit_command, "TT=20")
+            wait_for(lambda: len(simulator.commandTimes) > received)
+            simulator.dropRate = 0.0
+            wait_for(lambda: len(simulator.commandTimes) > received + 1)
+            resends.append(simulator.commandTimes[received + 1] - simulator.commandTimes[received])
+            time.sleep(0.01)
+        print("{} gateway: lost response resent after {:.3f} s (timeout {} s)".format(
+            name, max(resends), OTGW.commandTimeout))
+        loop.call_soon_threadsafe(client.stop)
+        task.result(10)
+        loop.call_soon_threadsafe(simulator.close)
+    loop.call_soon_threadsafe(loop.stop)
+
+
+@command_suppression(False)
+def bench_scheduler(count=2000, burst=100):
+    logging.disable(logging.WARNING)
+    words = ("TT", "TC", "CS", "OT", "SW", "HW", "CH")
+
+    def command(word, i):
+        return "{}={}".format(word, i % 2 if word in ("HW", "CH") else 15 + i % 10)
+
+    async def run():
+        simulator = await OTGWSimulator(rate=100, errorRate=0.01).start()
+        client = AsyncOTGWClient(simulator.host, simulator.port)
+        task = asyncio.ensure_future(client.run())
+        await client.send_command("TT=20")
+
+        # one command of every kind in flight, so nothing is superseded
+        received = simulator.commandsReceived
+        start = time.perf_counter()
+        results = []
+        for i in range(0, count, len(words)):
+            results += await asyncio.gather(*[client.submit_command(command(word, i)) for word in words])
+        elapsed = time.perf_counter() - start
+        print("distinct commands: {:.0f} commands/s, {} ok, {} gateway writes (SE retries included)".format(
+            len(results) / elapsed, sum(result.success for result in results), simulator.commandsReceived - received))
+
+        # a burst of setpoints for the same command word while the gateway is busy
+        received = simulator.commandsReceived
+        results = await asyncio.gather(*[client.submit_command(command("TT", i)) for i in range(burst)])
+        print("{} TT commands in a burst: {} gateway writes, {} superseded, last value {}".format(
+            burst, simulator.commandsReceived - received, sum(result.result == "superseded" for result in results),
+            results[-1].result))
+
+        # a safety command queued behind cosmetic ones
+        simulator.responseDelay = 0.005
+        order = []
+        futures = [client.submit_command(command(word, 1)) for word in ("TT", "TC", "OT", "SW", "CS", "CH")]
+        for future in futures:
+            future.add_done_callback(lambda future: order.append(future.result().commandWord))
+        await asyncio.gather(*futures)
+        print("completion order when CH is queued last: {}".format(" ".join(order)))
+
+        client.stop()
+        await task
+        simulator.close()
+
+    asyncio.run(run())
+
+
+def bench_suppression(count=50, interval=0.1):
+    # a home automation flow repeating the same setpoints while the gateway reports them
+    logging.disable(logging.WARNING)
+
+    async def run(suppress):
+        simulator = await OTGWSimulator(rate=100).start()
+        client = AsyncOTGWClient(simulator.host, simulator.port)
+        task = asyncio.ensure_future(client.run())
+        results = []
+        for i in range(count):
+            results.append(await client.send_command("TT=20" if i % 2 else "SW=55"))
+            await asyncio.sleep(interval)
+        client.stop()
+        await task
+        simulator.close()
+        print("suppression {:<3}: {} commands, {} gateway writes, {} skipped".format(
+            "on" if suppress else "off", count, simulator.commandsReceived,
+            sum(result.result == "unchanged" for result in results)))
+
+    for suppress in (False, True):
+        with command_suppression(suppress):
+            asyncio.run(run(suppress))
+
+
+def legacy_route(gateways, topic, payload, submit):
+    # OTGWBridge.__on_mqtt_message before the compiled routes: a fresh dict per message and a prefix scan
+    true_values = ('True', 'true', '1', 'y', 'yes')
+    command_generators = {
+        "room_setpoint/temporary": lambda _: "TT={:.2f}".format(float(_)),
+        "room_setpoint/constant": lambda _: "TC={:.2f}".format(float(_)),
+        "control_setpoint/temperature": lambda _: "CS={:.2f}".format(float(_)),
+        "outside_temperature": lambda _: "OT={:.2f}".format(float(_)),
+        "hot_water/enable": lambda _: "HW={}".format('1' if _ in true_values else '0'),
+        "hot_water/temperature": lambda _: "SW={:.2f}".format(float(_)),
+        "central_heating/enable": lambda _: "CH={}".format('1' if _ in true_values else '0'),
+    }
+    for setTopicNamespace, client in gateways:
+        prefix = setTopicNamespace + '/'
+        if topic.startswith(prefix):
+            command_generator = command_generators.get(topic[len(prefix):])
+            if command_generator:
+                submit(client, command_generator(payload))
+            return
+
+
+def bench_routing(counts=(1, 100, 1000), repeat=20000):
+    from otgw_bridge import OTGWBridge
+    import paho.mqtt.client as mqtt
+    logging.disable(logging.WARNING)
+
+    class CountingLoop:
+        submitted = 0
+
+        def call_soon_threadsafe(self, callback, *args):
+            self.submitted += 1
+
+    for count in counts:
+        config = {
+            "gateways": [{"name": "gw{}".format(i), "host": "127.0.0.1", "port": 0} for i in range(count)],
+            "mqtt": {"host": "127.0.0.1", "port": 1883, "username": None, "password": None,
+                     "value_topic_namespace": "value/otgw", "set_topic_namespace": "set/otgw",
+                     "qos": 0, "retain": False},
+        }
+        bridge = OTGWBridge(config)
+        loop = bridge._OTGWBridge__loop = CountingLoop()
+        client = bridge._OTGWBridge__mqttc
+        # the last gateway is the worst case for the prefix scan
+        topic = "set/otgw/gw{}/hot_water/temperature".format(count - 1)
+        message = mqtt.MQTTMessage(topic=topic.encode())
+        message.payload = b"55"
+        gateways = [("set/otgw/gw{}".format(i), None) for i in range(count)]
+        legacy = measure(lambda _: legacy_route(gateways, topic, "55", lambda client, command: None), [None], repeat)
+        routed = measure(lambda _: client._handle_on_message(message), [None], repeat)
+        if loop.submitted == 0:
+            raise AssertionError("Command was not routed")
+        print("{:>5} gateways: prefix scan {:8.0f} ns/message, topic trie {:8.0f} ns/message".format(
+            count, legacy * 1e9, routed * 1e9))
+
+
+class FakeMQTTBroker:
+    # just enough MQTT 3.1.1 to accept a client, ack its subscriptions and record its publishes
+
+    def __init__(self, on_publish=None):
+        self.on_publish = on_publish
+        self.publishes = 0
+        self.port = None
+
+    async def start(self):
+        self.__server = await asyncio.start_server(self.__handle, '127.0.0.1', 0)
+        self.port = self.__server.sockets[0].getsockname()[1]
+        return self
+
+    def close(self):
+        self.__server.close()
+
+    async def __handle(self, reader, writer):
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length, multiplier = 0, 1
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                command = header & 0xF0
+                if command == 0x10:
+                    writer.write(b'\x20\x02\x00\x00')
+                elif command == 0x30:
+                    received = time.perf_counter()
+                    topicLength = struct.unpack("!H", body[:2])[0]
+                    topic = body[2:2 + topicLength].decode()
+                    payload = body[2 + topicLength + (2 if header & 0x06 else 0):]
+                    if header & 0x06 == 0x02:
+                        writer.write(b'\x40\x02' + body[2 + topicLength:4 + topicLength])
+                    self.publishes += 1
+                    if self.on_publish:
+                        self.on_publish(topic, payload, received)
+                elif command == 0x80:
+                    granted = bytearray()
+                    position = 2
+                    while position < len(body):
+                        position += 3 + struct.unpack("!H", body[position:position + 2])[0]
+                        granted.append(0)
+                    writer.write(bytes([0x90, 2 + len(granted)]) + body[:2] + bytes(granted))
+                elif command == 0xC0:
+                    writer.write(b'\xd0\x00')
+                elif command == 0xE0:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+
+def run_loop_in_thread():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    return loop
+
+
+async def close_connections(server, connections):
+    server.close()
+    for writer in connections:
+        writer.close()
+    await asyncio.gather(*connections.values())
+
+
+def timed(samples, fn):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start)
+    return wrapper
+
+
+def latency_summary(samples, elapsed):
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "per_second": len(samples) / elapsed,
+        "p50_us": percentile(samples, 0.5) * 1e6,
+        "p99_us": percentile(samples, 0.99) * 1e6,
+        "p999_us": percentile(samples, 0.999) * 1e6,
+    }
+
+
+def bench_e2e(rate=200, duration=10):
+    # a fake gateway alternates boiler_water_temperature transactions carrying a counter with
+    # return_water_temperature ones; the broker maps every published counter back to its B frame
+    from otgw_bridge import OTGWBridge
+    import paho.mqtt.client as mqtt
+    logging.disable(logging.WARNING)
+
+    written = {}
+    endToEnd = []
+
+    def on_publish(topic, payload, received):
+        if topic.endswith("/boiler_water_temperature"):
+            sent = written.pop(payload.decode(), None)
+            if sent is not None:
+                endToEnd.append(received - sent)
+
+    chunks = []
+    received = []
+    stages = {name: [] for name in ("recv", "framing", "processLine", "translate", "publish", "packet_write")}
+
+    connections = {}
+
+    async def gateway(reader, writer):
+        connections[writer] = asyncio.current_task()
+        counter = 0
+        sentBytes = 0
+        while not writer.is_closing():
+            await asyncio.sleep(1.0 / rate)
+            counter = (counter + 1) % 4096
+            if counter % 2:
+                data = counter * 16
+                lines = OTGWSimulator.frame('T', 0, 25, 0) + "\r\n" + OTGWSimulator.frame('B', 4, 25, data) + "\r\n"
+                written[str(round(data / 256.0, 2))] = time.perf_counter()
+            else:
+                lines = OTGWSimulator.frame('T', 0, 28, 0) + "\r\n" + OTGWSimulator.frame('B', 4, 28, 0x3200) + "\r\n"
+            sentBytes += len(lines)
+            writer.write(lines.encode())
+            chunks.append((sentBytes, time.perf_counter()))
+
+    protocol = AsyncOTGWClient.Protocol
+    originals = {
+        (protocol, "buffer_updated"): protocol.buffer_updated,
+        (LineFramer, "feed"): LineFramer.feed,
+        (OTGW, "processLine"): OTGW.processLine,
+        (OTGWBridge, "_OTGWBridge__otgw_translate_message"): OTGWBridge._OTGWBridge__otgw_translate_message,
+        (mqtt.Client, "publish_batch"): mqtt.Client.publish_batch,
+        (mqtt.Client, "_packet_write"): mqtt.Client._packet_write,
+    }
+
+    def buffer_updated(self, nbytes):
+        now = time.perf_counter()
+        received.append(nbytes)
+        total = sum(received)
+        while chunks and chunks[0][0] <= total:
+            stages["recv"].append(now - chunks.pop(0)[1])
+        return originals[(protocol, "buffer_updated")](self, nbytes)
+
+    protocol.buffer_updated = buffer_updated
+    LineFramer.feed = timed(stages["framing"], LineFramer.feed)
+    OTGW.processLine = timed(stages["processLine"], OTGW.processLine)
+    OTGWBridge._OTGWBridge__otgw_translate_message = timed(stages["translate"], OTGWBridge._OTGWBridge__otgw_translate_message)
+    mqtt.Client.publish_batch = timed(stages["publish"], mqtt.Client.publish_batch)
+    mqtt.Client._packet_write = timed(stages["packet_write"], mqtt.Client._packet_write)
+    try:
+        loop = run_loop_in_thread()
+        broker = asyncio.run_coroutine_threadsafe(FakeMQTTBroker(on_publish).start(), loop).result()
+        server = asyncio.run_coroutine_threadsafe(asyncio.start_server(gateway, '127.0.0.1', 0), loop).result()
+        config = {
+            "otgw": {"host": "127.0.0.1", "port": server.sockets[0].getsockname()[1], "thermostatFirst": False},
+            "mqtt": {"host": "127.0.0.1", "port": broker.port, "username": None, "password": None,
+                     "value_topic_namespace": "value/otgw", "set_topic_namespace": "set/otgw",
+                     "qos": 0, "retain": False},
+        }
+        bridge = OTGWBridge(config)
+        bridgeThread = threading.Thread(target=bridge.run, daemon=True)
+        bridgeThread.start()
+        time.sleep(1)
+        for samples in list(stages.values()) + [endToEnd]:
+            del samples[:]
+        start = time.perf_counter()
+        time.sleep(duration)
+        elapsed = time.perf_counter() - start
+        results = {name: latency_summary(list(samples), elapsed) for name, samples in stages.items()}
+        results["end_to_end"] = latency_summary(list(endToEnd), elapsed)
+        bridge.stop()
+        bridgeThread.join()
+        # the fake gateway writes until its connection is closed, stopping the loop under it would
+        # destroy the pending handler
+        asyncio.run_coroutine_threadsafe(close_connections(server, connections), loop).result()
+        loop.call_soon_threadsafe(broker.close)
+        loop.call_soon_threadsafe(loop.stop)
+    finally:
+        for (owner, name), original in originals.items():
+            setattr(owner, name, original)
+    print(json.dumps({"rate": rate, "duration": duration, "stages": results}, indent=2, sort_keys=True))
+
+
+def fake_broker_process(portQueue):
+    async def serve():
+        broker = await FakeMQTTBroker().start()
+        portQueue.put(broker.port)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+class CountingSocket:
+    # counts send() and recv() calls of the wrapped socket, everything else is delegated
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sends = 0
+        self.recvs = 0
+
+    def send(self, data):
+        self.sends += 1
+        return self.sock.send(data)
+
+    def sendmsg(self, buffers):
+        self.sends += 1
+        return self.sock.sendmsg(buffers)
+
+    def recv(self, size):
+        self.recvs += 1
+        return self.sock.recv(size)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def connected_mqtt_client(port):
+    import paho.mqtt.client as mqtt
+    client = mqtt.Client("benchmark")
+    client.connect("127.0.0.1", port)
+    client._sock = CountingSocket(client._sock)
+    thread = threading.Thread(target=client.loop_forever, daemon=True)
+    thread.start()
+    return client, thread
+
+
+def legacy_packet_read(self):
+    # paho's reader before the input buffer: recv(1) for the command, recv(1) per remaining
+    # length byte, then recv() the body onto a bytes object; partial reads are not resumed here
+    import paho.mqtt.client as mqtt
+    try:
+        command = self._sock.recv(1)
+    except BlockingIOError:
+        return mqtt.MQTT_ERR_AGAIN
+    if len(command) == 0:
+        return 1
+    length, mult = 0, 1
+    while True:
+        byte = self._sock.recv(1)[0]
+        length += (byte & 127) * mult
+        mult *= 128
+        if not byte & 128:
+            break
+    packet = b""
+    while len(packet) < length:
+        packet += self._sock.recv(length - len(packet))
+    self._in_packet = {"command": command[0], "remaining_length": length, "packet": packet, "pos": 0}
+    return self._packet_handle()
+
+
+def bench_reading(count=20000):
+    # a broker that answers CONNECT with CONNACK followed by a flood of retained set/otgw messages
+    import paho.mqtt.client as mqtt
+    logging.disable(logging.WARNING)
+    flood = bytearray()
+    for i in range(count):
+        body = struct.pack("!H", 27) + "set/otgw/room_setpoint/temp".encode() + str(15 + i % 10).encode()
+        flood += bytes([0x31, len(body)]) + body
+
+    async def handle(reader, writer):
+        await reader.read(1024)
+        writer.write(b'\x20\x02\x00\x00' + bytes(flood))
+        await reader.read(1024)
+        writer.close()
+
+    loop = run_loop_in_thread()
+    server = asyncio.run_coroutine_threadsafe(asyncio.start_server(handle, '127.0.0.1', 0), loop).result()
+    port = server.sockets[0].getsockname()[1]
+    original = mqtt.Client._packet_read
+    for name, reader in (("recv per field", legacy_packet_read), ("buffered", original)):
+        mqtt.Client._packet_read = reader
+        received = []
+        done = threading.Event()
+
+        def on_message(client, userdata, message):
+            received.append(message.payload)
+            if len(received) == count:
+                done.set()
+
+        client = mqtt.Client("benchmark")
+        client.on_message = on_message
+        client.connect("127.0.0.1", port)
+        client._sock = CountingSocket(client._sock)
+        cpuStart, wallStart = time.process_time(), time.perf_counter()
+        thread = threading.Thread(target=client.loop_forever, daemon=True)
+        thread.start()
+        done.wait(60)
+        elapsed = time.perf_counter() - wallStart
+        cpu = time.process_time() - cpuStart
+        recvs = client._sock.recvs
+        client.disconnect()
+        thread.join()
+        print("{:<15} {} messages in {:6.1f} ms, {:6} recv() calls, {:6.1f} us CPU/message".format(
+            name, len(received), elapsed * 1000, recvs, cpu / count * 1e6))
+    mqtt.Client._packet_read = original
+    loop.call_soon_threadsafe(server.close)
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def legacy_packet_write(self):
+    # paho's writer before scatter/gather: one send() of a copied slice per packet and the
+    # queue lock taken for every packet (socket errors left out)
+    import paho.mqtt.client as mqtt
+    with self._current_out_packet_mutex:
+        while self._current_out_packet:
+            packet = self._current_out_packet
+            try:
+                write_length = self._sock.send(packet['packet'][packet['pos']:])
+            except BlockingIOError:
+                return mqtt.MQTT_ERR_AGAIN
+            if write_length <= 0:
+                break
+            packet['to_process'] -= write_length
+            packet['pos'] += write_length
+            if packet['to_process'] == 0:
+                if packet['command'] & 0xF0 == mqtt.PUBLISH and packet['qos'] == 0:
+                    infos = packet['info'] if isinstance(packet['info'], list) else (packet['info'],)
+                    for info in infos:
+                        with self._callback_mutex:
+                            if self.on_publish:
+                                with self._in_callback:
+                                    self.on_publish(self, self._userdata, info.mid)
+                        info._set_as_published()
+                if packet['command'] & 0xF0 == mqtt.DISCONNECT:
+                    self._sock.close()
+                    self._sock = None
+                    return mqtt.MQTT_ERR_SUCCESS
+                with self._out_packet_mutex:
+                    self._current_out_packet = self._out_packet.popleft() if self._out_packet else None
+    return mqtt.MQTT_ERR_SUCCESS
+
+
+def bench_writing(count=20000, rounds=6):
+    # a burst of small telemetry publishes queued faster than the socket drains them; the
+    # writers take turns going first since whichever runs second pays for the first one's
+    # garbage and looks a few us/message worse
+    import paho.mqtt.client as mqtt
+    logging.disable(logging.WARNING)
+    loop = run_loop_in_thread()
+    broker = asyncio.run_coroutine_threadsafe(FakeMQTTBroker().start(), loop).result()
+    original = mqtt.Client._packet_write
+    writers = [("send per packet", legacy_packet_write), ("scatter/gather", original)]
+    samples = {name: [] for name, writer in writers}
+    for round in range(rounds):
+        for name, writer in writers if round % 2 == 0 else writers[::-1]:
+            writerCpu = [0.0]
+
+            def timed_write(self, writer=writer, writerCpu=writerCpu):
+                start = time.thread_time()
+                try:
+                    return writer(self)
+                finally:
+                    writerCpu[0] += time.thread_time() - start
+
+            mqtt.Client._packet_write = timed_write
+            gc.collect()
+            # loop_start(): publish() only queues and the network thread writes what piled up
+            client = mqtt.Client("benchmark")
+            client.connect("127.0.0.1", broker.port)
+            client._sock = CountingSocket(client._sock)
+            client.loop_start()
+            time.sleep(0.2)
+            sends = client._sock.sends
+            writerCpu[0] = 0.0
+            cpuStart, wallStart = time.process_time(), time.perf_counter()
+            infos = [client.publish("value/otgw/boiler_water_temperature", 40 + i % 200 / 10.0) for i in range(count)]
+            infos[-1].wait_for_publish()
+            elapsed = time.perf_counter() - wallStart
+            cpu = time.process_time() - cpuStart
+            samples[name].append((elapsed, client._sock.sends - sends, writerCpu[0], cpu))
+            client.disconnect()
+            client.loop_stop()
+            del infos
+    mqtt.Client._packet_write = original
+    print("median of {} rounds, {} messages each".format(rounds, count))
+    for name, writer in writers:
+        elapsed, sends, writerCpu, cpu = (sorted(values)[len(values) // 2] for values in zip(*samples[name]))
+        print("{:<16} {:6.1f} ms, {:6} send calls, writer {:4.1f} us/message, process {:5.1f} us CPU/message".format(
+            name, elapsed * 1000, sends, writerCpu / count * 1e6, cpu / count * 1e6))
+    loop.call_soon_threadsafe(broker.close)
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def bench_publish_call(count=200000):
+    # cost of building one QoS 0 publish() packet on the bridge's topics; queueing and the
+    # network loop wakeup are left out, they are the same with and without the topic cache
+    import paho.mqtt.client as mqtt
+    topics = ["value/otgw/" + name for name in ("boiler_water_temperature", "return_water_temperature",
+              "room_temperature", "room_setpoint", "control_setpoint", "modulation_level", "dhw_temperature",
+              "ch_water_pressure", "outside_temperature", "status/flame", "status/ch_active", "status/dhw_active")]
+    for name, cacheSize in (("encode per call", 0), ("cached topics", 256)):
+        client = mqtt.Client("benchmark")
+        client._sock = object()
+        client._packet_queue = lambda command, packet, mid, qos, info=None: mqtt.MQTT_ERR_SUCCESS
+        client._topic_cache_size = cacheSize
+        rounds = []
+        for _ in range(count // 1000):
+            start = time.perf_counter()
+            for i in range(1000):
+                client.publish(topics[i % len(topics)], "45.50")
+            rounds.append(time.perf_counter() - start)
+        client._sock = None
+        rounds.sort()
+        print("{:<16} {:5.2f} us/publish() median, {:5.2f} us best".format(
+            name, rounds[len(rounds) // 2] / 1000 * 1e6, rounds[0] / 1000 * 1e6))
+
+
+def legacy_inflight_client():
+    # paho's in-flight tracking before the mid index: lists searched by mid and a retry check
+    # that looks at every message
+    import paho.mqtt.client as mqtt
+
+    class LegacyClient(mqtt.Client):
+
+        def _message_retry_check(self):
+            for messages, mutex in ((self._out_messages, self._out_message_mutex),
+                                    (self._in_messages, self._in_message_mutex)):
+                with mutex:
+                    now = mqtt.time_func()
+                    for m in messages:
+                        if m.timestamp + self._message_retry < now:
+                            if m.state in (mqtt.mqtt_ms_wait_for_puback, mqtt.mqtt_ms_wait_for_pubrec):
+                                m.timestamp = now
+                                m.dup = True
+                                self._send_publish(m.mid, m.topic.encode('utf-8'), m.payload, m.qos, m.retain, m.dup)
+
+        def _handle_pubackcomp(self, cmd):
+            mid, = struct.unpack("!H", self._in_packet['packet'])
+            with self._out_message_mutex:
+                for i in range(len(self._out_messages)):
+                    if self._out_messages[i].mid == mid:
+                        return self._do_on_publish(i)
+            return mqtt.MQTT_ERR_SUCCESS
+
+        def _do_on_publish(self, idx):
+            msg = self._out_messages.pop(idx)
+            self._inflight_messages -= 1
+            msg.info._set_as_published()
+            return mqtt.MQTT_ERR_SUCCESS
+
+    return LegacyClient("benchmark")
+
+
+def bench_inflight(count=10000):
+    # 10k QoS 1 telemetry messages outstanding during a broker hiccup: the periodic retry check
+    # while none is due yet, then the PUBACKs arriving in random order
+    import paho.mqtt.client as mqtt
+    acks = list(range(1, count + 1))
+    random.Random(1).shuffle(acks)
+    for name, factory in (("lists", legacy_inflight_client), ("indexed", lambda: mqtt.Client("benchmark"))):
+        client = factory()
+        client._sock = object()
+        client._packet_queue = lambda command, packet, mid, qos, info=None: mqtt.MQTT_ERR_SUCCESS
+        client.max_inflight_messages_set(0)
+        client.max_queued_messages_set(0)
+        for i in range(count):
+            client.publish("value/otgw/boiler_water_temperature", "45.50", qos=1)
+        if name == "lists":
+            client._out_messages = list(client._out_messages.values())
+        start = time.perf_counter()
+        for _ in range(100):
+            client._message_retry_check()
+        retryCheck = (time.perf_counter() - start) / 100
+        start = time.perf_counter()
+        for mid in acks:
+            client._in_packet['remaining_length'] = 2
+            client._in_packet['packet'] = struct.pack("!H", mid)
+            client._handle_pubackcomp("PUBACK")
+        acked = time.perf_counter() - start
+        assert not client._out_messages
+        client._sock = None
+        print("{:<8} retry check {:8.1f} us with {} outstanding, {} PUBACKs in {:7.1f} ms ({:5.1f} us each)".format(
+            name, retryCheck * 1e6, count, count, acked * 1000, acked / count * 1e6))
+
+
+def legacy_websocket_wrapper():
+    # paho's websocket framing before word-wide masking: per-byte XOR loops, the frame header
+    # parsed again for every read and the read buffer re-sliced
+    import errno
+    import socket
+    from paho.mqtt.client import WebsocketWrapper
+
+    class LegacyWebsocketWrapper(WebsocketWrapper):
+
+        def _create_frame(self, opcode, data, do_masking=1):
+            header = bytearray([1 << 7 | opcode])
+            length = len(data)
+            mask_key = bytearray([random.randint(0, 255) for _ in range(4)])
+            if length < 126:
+                header.append(do_masking << 7 | length)
+            elif length < 32768:
+                header.append(do_masking << 7 | 126)
+                header += struct.pack("!H", length)
+            else:
+                header.append(do_masking << 7 | 127)
+                header += struct.pack("!Q", length)
+            if do_masking:
+                for index in range(length):
+                    data[index] ^= mask_key[index % 4]
+                data = mask_key + data
+            return header + data
+
+        def _buffered_read(self, length):
+            wanted_bytes = length - (len(self._readbuffer) - self._readbuffer_head)
+            if wanted_bytes > 0:
+                data = self._socket.recv(wanted_bytes)
+                if not data:
+                    raise socket.error(errno.ECONNABORTED, 0)
+                self._readbuffer.extend(data)
+                if len(data) < wanted_bytes:
+                    raise socket.error(errno.EAGAIN, 0)
+            self._readbuffer_head += length
+            return self._readbuffer[self._readbuffer_head - length:self._readbuffer_head]
+
+        def _recv_impl(self, length):
+            self._readbuffer_head = 0
+            header = self._buffered_read(2)
+            maskbit = header[1] & 0x80
+            payload_length = header[1] & 0x7f
+            if payload_length == 0x7e:
+                payload_length, = struct.unpack("!H", self._buffered_read(2))
+            elif payload_length == 0x7f:
+                payload_length, = struct.unpack("!Q", self._buffered_read(8))
+            mask_key = self._buffered_read(4) if maskbit else None
+            readindex = min(self._payload_head + length, payload_length)
+            payload = self._buffered_read(readindex)
+            if maskbit:
+                for index in range(self._payload_head, readindex):
+                    payload[index] ^= mask_key[index % 4]
+            result = payload[self._payload_head:readindex]
+            self._payload_head = readindex
+            if readindex == payload_length:
+                self._readbuffer = bytearray()
+                self._payload_head = 0
+            return result
+
+        def _send_impl(self, data):
+            frame = self._create_frame(WebsocketWrapper.OPCODE_BINARY, bytearray(data))
+            self._sendbuffer.extend(frame)
+            length = self._socket.send(self._sendbuffer)
+            self._sendbuffer = self._sendbuffer[length:]
+            return len(data)
+
+    return LegacyWebsocketWrapper
+
+
+class StreamSocket:
+    # hands out a prepared byte stream, at most chunk bytes per recv(); send() discards
+
+    def __init__(self, data=b"", chunk=65536):
+        self.data = memoryview(data)
+        self.pos = 0
+        self.chunk = chunk
+
+    def recv(self, size):
+        size = min(size, self.chunk)
+        data = bytes(self.data[self.pos:self.pos + size])
+        self.pos += len(data)
+        return data
+
+    def send(self, data):
+        return len(data)
+
+
+def bench_websocket(total=4 * 1024 * 1024):
+    # MQTT over websockets through a proxy: masking outgoing frames and reading masked frames,
+    # in MB/s of payload for several frame sizes
+    from paho.mqtt.client import WebsocketWrapper
+    legacy = legacy_websocket_wrapper()
+
+    def wrapper(cls, sock):
+        ws = cls.__new__(cls)
+        ws._socket = sock
+        ws._ssl = False
+        ws.connected = True
+        ws._sendbuffer = bytearray()
+        ws._readbuffer = bytearray()
+        ws._requested_size = 0
+        ws._frame = None
+        ws._payload_head = 0
+        ws._readbuffer_head = 0
+        return ws
+
+    for size in (64, 1024, 16384, 262144):
+        payload = bytes(random.getrandbits(8) for _ in range(size))
+        frames = max(1, total // size)
+        stream = b"".join(wrapper(WebsocketWrapper, None)._create_frame(WebsocketWrapper.OPCODE_BINARY, payload)
+                          for _ in range(frames))
+        results = []
+        for cls in (legacy, WebsocketWrapper):
+            ws = wrapper(cls, StreamSocket())
+            start = time.perf_counter()
+            for _ in range(frames):
+                ws.send(payload)
+            sendRate = frames * size / (time.perf_counter() - start) / 1e6
+            ws = wrapper(cls, StreamSocket(stream))
+            received = 0
+            start = time.perf_counter()
+            while received < frames * size:
+                received += len(ws.recv(65536))
+            recvRate = received / (time.perf_counter() - start) / 1e6
+            results.append((sendRate, recvRate))
+        print("{:6} byte frames  send {:7.1f} -> {:7.1f} MB/s   recv {:7.1f} -> {:7.1f} MB/s".format(
+            size, results[0][0], results[1][0], results[0][1], results[1][1]))
+
+
+def bench_publishing(rate=500, duration=3):
+    # one status message fans out to four topics, published at `rate` messages per second
+    topics = ["value/otgw/status/{}".format(name) for name in ("fault", "ch_active", "dhw_active", "flame")]
+    portQueue = multiprocessing.Queue()
+    broker = multiprocessing.Process(target=fake_broker_process, args=(portQueue,), daemon=True)
+    broker.start()
+    port = portQueue.get()
+
+    def per_value(client, loop):
+        def publish():
+            for topic in topics:
+                client.publish(topic, "False", 0, False)
+        return publish
+
+    def batched(window):
+        def factory(client, loop):
+            publisher = BatchPublisher(client, 0, False, window, loop)
+
+            def publish():
+                for topic in topics:
+                    publisher.add(topic, "False")
+                publisher.end_message()
+            return publish
+        return factory
+
+    async def drive(publish):
+        count = int(rate * duration)
+        start = time.perf_counter()
+        for i in range(count):
+            publish()
+            delay = start + (i + 1) / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await asyncio.sleep(0.2)
+
+    for name, factory in (("publish() per value", per_value), ("batch per message", batched(0)),
+                          ("batch, 50 ms window", batched(0.05))):
+        client, thread = connected_mqtt_client(port)
+        time.sleep(0.2)
+        loop = asyncio.new_event_loop()
+        publish = factory(client, loop)
+        sends = client._sock.sends
+        cpuStart, wallStart = time.process_time(), time.perf_counter()
+        loop.run_until_complete(drive(publish))
+        elapsed = time.perf_counter() - wallStart
+        cpu = time.process_time() - cpuStart
+        sends = client._sock.sends - sends
+        loop.close()
+        client.disconnect()
+        thread.join()
+        print("{:<22} {:8.0f} send()/s {:6.2f} % CPU ({} status messages/s)".format(
+            name, sends / elapsed, cpu / elapsed * 100, rate))
+    broker.terminate()
+    broker.join()
+
+
+benchmarks = {
+    "decoder": bench_decoder,
+    "schema": bench_schema,
+    "status": bench_status,
+    "memory": bench_memory,
+    "assembly": bench_assembly,
+    "framing": bench_framing,
+    "gateways": bench_gateways,
+    "commands": bench_commands,
+    "dispatch": bench_dispatch,
+    "scheduler": bench_scheduler,
+    "suppression": bench_suppression,
+    "routing": bench_routing,
+    "e2e": bench_e2e,
+    "publishing": bench_publishing,
+    "reading": bench_reading,
+    "writing": bench_writing,
+    "publish_call": bench_publish_call,
+    "inflight": bench_inflight,
+    "websocket": bench_websocket,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or benchmarks.keys():
+        print("== {} ==".format(name))
+        benchmarks[name]()
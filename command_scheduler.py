@@ -0,0 +1,77 @@
+import heapq
+import itertools
+
+
+class CommandScheduler:
+
+    # commands leave in priority order (lower first) and FIFO within a priority. A queued
+    # command is replaced by a newer one with the same command word, and at most maxSize
+    # commands wait; retries wait in a separate heap until their backoff has passed
+    def __init__(self, maxSize=32):
+        self.maxSize = maxSize
+        self.__ready = []
+        self.__delayed = []
+        self.__queued = {}
+        self.__sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.__queued)
+
+    def __contains__(self, commandWord):
+        return commandWord in self.__queued
+
+    # queues the command and returns (command, reason) for every command it pushed out,
+    # which may be the command itself; reason is "superseded" or "dropped" for a full queue
+    def push(self, command, notBefore=0):
+        if command.sequence is None:
+            command.sequence = next(self.__sequence)
+        removed = []
+        other = self.__queued.get(command.commandWord)
+        if other is not None:
+            if other.sequence > command.sequence:
+                # a retry of a command that was overtaken while it was in flight
+                return [(command, "superseded")]
+            removed.append((other, "superseded"))
+        elif len(self.__queued) >= self.maxSize:
+            victim = max(self.__queued.values(), key=lambda queued: (queued.priority, queued.sequence))
+            if command.priority >= victim.priority:
+                return [(command, "dropped")]
+            del self.__queued[victim.commandWord]
+            removed.append((victim, "dropped"))
+        self.__queued[command.commandWord] = command
+        if notBefore:
+            heapq.heappush(self.__delayed, (notBefore, command.priority, command.sequence, command))
+        else:
+            heapq.heappush(self.__ready, (command.priority, command.sequence, command))
+        return removed
+
+    def pop(self, now):
+        self.__promote(now)
+        while self.__ready:
+            command = heapq.heappop(self.__ready)[2]
+            # superseded commands stay in the heaps until they come up
+            if self.__queued.get(command.commandWord) is command:
+                del self.__queued[command.commandWord]
+                return command
+        return None
+
+    # removes and returns the queued commands whose deadline has passed
+    def expire(self, now):
+        expired = [command for command in self.__queued.values() if command.expires <= now]
+        for command in expired:
+            del self.__queued[command.commandWord]
+        return expired
+
+    # earliest time something changes without a new command: a retry becomes ready or a deadline passes
+    def nextEvent(self, now):
+        self.__promote(now)
+        times = [command.expires for command in self.__queued.values()]
+        if self.__delayed:
+            times.append(self.__delayed[0][0])
+        return min(times) if times else None
+
+    def __promote(self, now):
+        delayed = self.__delayed
+        while delayed and delayed[0][0] <= now:
+            notBefore, priority, sequence, command = heapq.heappop(delayed)
+            heapq.heappush(self.__ready, (priority, sequence, command))
@@ -0,0 +1,115 @@
+import json
+
+
+class CommandSpec:
+    __slots__ = ("topic", "code", "parse", "minimum", "maximum", "format")
+
+    # topic is a template below the gateway's set topic namespace, `{namespace}/...`
+    def __init__(self, topic, code, parse, minimum=None, maximum=None, format="{}"):
+        self.topic = topic
+        self.code = code
+        self.parse = parse
+        self.minimum = minimum
+        self.maximum = maximum
+        self.format = format
+
+    def topic_for(self, namespace):
+        return self.topic.format(namespace=namespace)
+
+    # gateway command line for an MQTT payload, ValueError when the payload is not acceptable
+    def command(self, payload):
+        if isinstance(payload, (bytes, bytearray)):
+            payload = payload.decode('utf-8')
+        value = self.parse(payload.strip())
+        if value != value or self.minimum is not None and value < self.minimum \
+                or self.maximum is not None and value > self.maximum:
+            raise ValueError("{} out of range {}..{} for {}".format(value, self.minimum, self.maximum, self.code))
+        return "{}={}".format(self.code, self.format.format(value))
+
+
+# payload and correlation id of a command message: a plain value, or a JSON object
+# {"value": ..., "correlation_id": ...}; ValueError when the object is malformed
+def command_request(payload):
+    if isinstance(payload, (bytes, bytearray)):
+        payload = payload.decode('utf-8')
+    if not payload.lstrip().startswith('{'):
+        return payload, None
+    request = json.loads(payload)
+    if "value" not in request:
+        raise ValueError("Command request without value")
+    value = request["value"]
+    if isinstance(value, bool):
+        value = int(value)
+    return str(value), request.get("correlation_id")
+
+
+trueValues = ('True', 'true', '1', 'y', 'yes', 'on', 'ON')
+falseValues = ('False', 'false', '0', 'n', 'no', 'off', 'OFF')
+
+
+def parse_bool(payload):
+    if payload in trueValues:
+        return 1
+    if payload in falseValues:
+        return 0
+    raise ValueError("Not a boolean: '{}'".format(payload))
+
+
+commandSpecs = (
+    CommandSpec("{namespace}/room_setpoint/temporary", "TT", float, 0, 30, "{:.2f}"),
+    CommandSpec("{namespace}/room_setpoint/constant", "TC", float, 0, 30, "{:.2f}"),
+    CommandSpec("{namespace}/control_setpoint/temperature", "CS", float, 0, 90, "{:.2f}"),
+    CommandSpec("{namespace}/outside_temperature", "OT", float, -40, 64, "{:.2f}"),
+    CommandSpec("{namespace}/hot_water/enable", "HW", parse_bool),
+    CommandSpec("{namespace}/hot_water/temperature", "SW", float, 0, 127, "{:.2f}"),
+    CommandSpec("{namespace}/central_heating/enable", "CH", parse_bool),
+)
+
+# a batch names its commands by code or by topic below the namespace
+specsByName = {}
+for _spec in commandSpecs:
+    specsByName[_spec.code] = _spec
+    specsByName[_spec.topic_for("").lstrip("/")] = _spec
+del _spec
+
+batchTopic = "{namespace}/batch"
+# below the value topic namespace
+resultTopic = "{namespace}/command/result"
+batchResultTopic = "{namespace}/batch/result"
+
+
+# command lines of a batch payload: a JSON list of "XX=value" strings, a JSON object mapping
+# codes or topics to values (and optionally "correlation_id"), or one "XX=value" per line;
+# returns the command lines and the correlation id, ValueError when any entry is not acceptable
+# or names a command twice (the scheduler would supersede the earlier one)
+def batch_commands(payload):
+    if isinstance(payload, (bytes, bytearray)):
+        payload = payload.decode('utf-8')
+    try:
+        entries = json.loads(payload)
+    except ValueError:
+        entries = [line for line in payload.splitlines() if line.strip()]
+    correlationId = None
+    if isinstance(entries, dict):
+        correlationId = entries.pop("correlation_id", None)
+        entries = list(entries.items())
+    elif isinstance(entries, list):
+        entries = [str(entry).partition("=")[::2] for entry in entries]
+    else:
+        raise ValueError("Batch must be a list or an object")
+    commands = []
+    codes = set()
+    for name, value in entries:
+        spec = specsByName.get(name.strip())
+        if spec is None:
+            raise ValueError("Unknown command '{}'".format(name))
+        if spec.code in codes:
+            raise ValueError("Command {} given more than once".format(spec.code))
+        codes.add(spec.code)
+        if isinstance(value, bool):
+            value = int(value)
+        commands.append(spec.command(str(value)))
+    if not commands:
+        raise ValueError("Empty batch")
+    return commands, correlationId
+
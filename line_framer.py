@@ -0,0 +1,25 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class LineFramer:
+
+    def __init__(self, maxLineLength=1024):
+        self.__buffer = bytearray()
+        self.__maxLineLength = maxLineLength
+
+    def feed(self, data):
+        buffer = self.__buffer
+        buffer += data
+        # everything up to the last line break is complete, split it in one pass
+        end = max(buffer.rfind(b'\n'), buffer.rfind(b'\r')) + 1
+        if end == 0:
+            if len(buffer) > self.__maxLineLength:
+                log.warning("Dropping {} bytes without line break".format(len(buffer)))
+                buffer.clear()
+            return []
+        lines = buffer[:end].splitlines()
+        del buffer[:end]
+        # gateway output is ascii, anything else is line noise that the parsers reject
+        return [line.decode('utf-8', 'replace') for line in lines if line]
@@ -0,0 +1,164 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    __slots__ = ("value", "function")
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+
+class Histogram:
+    defaultBuckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=defaultBuckets):
+        self.buckets = tuple(buckets)
+        # one slot per bucket plus +Inf, cumulated only when collected
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__families = {}
+
+    def __get(self, kind, name, help, labels, factory):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            family = self.__families.setdefault(name, (kind, help, {}))
+            if family[0] != kind:
+                raise ValueError("Metric {} already registered as {}".format(name, family[0]))
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = factory()
+            return metric
+
+    # metrics are created once by their owner and then updated without any lookup
+    def counter(self, name, help, **labels):
+        return self.__get("counter", name, help, labels, Counter)
+
+    def gauge(self, name, help, function=None, **labels):
+        gauge = self.__get("gauge", name, help, labels, Gauge)
+        if function:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help, buckets=Histogram.defaultBuckets, **labels):
+        return self.__get("histogram", name, help, labels, lambda: Histogram(buckets))
+
+    def collect(self):
+        with self.__lock:
+            return [(name, kind, help, list(metrics.items()))
+                    for name, (kind, help, metrics) in sorted(self.__families.items())]
+
+    def snapshot(self):
+        result = {}
+        for name, kind, help, metrics in self.collect():
+            for labels, metric in metrics:
+                if kind == "histogram":
+                    value = {"count": metric.count, "sum": metric.sum}
+                elif kind == "gauge":
+                    value = metric.get()
+                else:
+                    value = metric.value
+                result[(name,) + labels] = value
+        return result
+
+    def render(self):
+        def format_labels(labels, extra=()):
+            labels = labels + extra
+            if not labels:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+        lines = []
+        for name, kind, help, metrics in self.collect():
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, metric in metrics:
+                if kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + ("+Inf",), metric.counts):
+                        cumulative += count
+                        lines.append("{}_bucket{} {}".format(name, format_labels(labels, (("le", bound),)), cumulative))
+                    lines.append("{}_sum{} {}".format(name, format_labels(labels), metric.sum))
+                    lines.append("{}_count{} {}".format(name, format_labels(labels), metric.count))
+                elif kind == "gauge":
+                    lines.append("{}{} {}".format(name, format_labels(labels), metric.get()))
+                else:
+                    lines.append("{}{} {}".format(name, format_labels(labels), metric.value))
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class PrometheusExporter:
+
+    def __init__(self, registry, host="0.0.0.0", port=9105):
+        self.__registry = registry
+        self.__host = host
+        self.__port = port
+        self.__server = None
+
+    def start(self):
+        if self.__server:
+            raise RuntimeError("Already running")
+        registry = self.__registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer((self.__host, self.__port), Handler)
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        log.info("Serving metrics on {}:{}".format(self.__host, self.__server.server_address[1]))
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__server = None
@@ -0,0 +1,41 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class BatchPublisher:
+
+    # collects the values produced by one OTGW message, or by every message within
+    # `window` seconds, and hands them to the MQTT client as a single batch
+    def __init__(self, client, qos=0, retain=False, window=0, loop=None):
+        self.__client = client
+        self.__qos = qos
+        self.__retain = retain
+        self.__window = window
+        self.__loop = loop
+        self.__pending = []
+        self.__flushScheduled = False
+
+    def add(self, topic, payload):
+        self.__pending.append((topic, payload, self.__retain))
+
+    def end_message(self):
+        if not self.__pending:
+            return
+        if not self.__window:
+            self.flush()
+        elif not self.__flushScheduled:
+            self.__flushScheduled = True
+            self.__loop.call_later(self.__window, self.flush)
+
+    def flush(self):
+        self.__flushScheduled = False
+        pending, self.__pending = self.__pending, []
+        if not pending:
+            return
+        if self.__qos == 0:
+            self.__client.publish_batch(pending)
+        else:
+            # acknowledged messages are tracked one by one by the client
+            for topic, payload, retain in pending:
+                self.__client.publish(topic=topic, payload=payload, qos=self.__qos, retain=retain)
@@ -9,13 +9,13 @@ log = logging.getLogger(__name__)
 
 class OledController:
 
-    __worker_thread = None
-    __dhw = deque([])
-
     loader = ["/", "-", "\\", "|"]
 
     def __init__(self, host):
         self.__host = host
+        self.__worker_thread = None
+        self.__dhw = deque([])
+        self.lastRows = {}
 
     def start(self):
         if self.__worker_thread:
@@ -44,8 +44,6 @@ class OledController:
     def __build_url(self, command):
         return "http://{}/control?cmd={}".format(self.__host, command)
 
-    lastRows = {}
-
     def __worker(self):
         id = 0
         r = requests.get(self.__build_url("oledcmd,clear"))
@@ -1,100 +1,241 @@
 import logging
-import re
-from collections import deque
 import time
+from metrics import registry
+from command_scheduler import CommandScheduler
 
 log = logging.getLogger(__name__)
 
+# the gateway prints frames in upper case hex, anything else is noise
+hexDigits = frozenset("0123456789ABCDEF")
+
 
 class OTGW:
 
     class Message:
         class MessageLine:
-            def flags_converter(val):
-                return "{0:b}".format(val)
-
             def float_converter(val):
-                return round(val / float(256), 2)
+                # f8.8 is a signed fixed point number
+                return round((val - 0x10000 if val & 0x8000 else val) / 256.0, 2)
 
             def int_converter(val):
                 return val
 
-            openthermIds = {
-                0: ("status", flags_converter,),
-                1: ("control_setpoint", float_converter,),
-                9: ("remote_override_setpoint", float_converter,),
-                # 14: ("max_relative_modulation_level", float_converter,),
-                16: ("room_setpoint", float_converter,),
-                # 17: ("relative_modulation_level", float_converter,),
-                18: ("ch_water_pressure", float_converter,),
-                24: ("room_temperature", float_converter,),
-                25: ("boiler_water_temperature", float_converter,),
-                26: ("dhw_temperature", float_converter,),
-                27: ("outside_temperature", float_converter,),
-                28: ("return_water_temperature", float_converter,),
-                56: ("dhw_setpoint", float_converter,),
-                57: ("max_ch_water_setpoint", float_converter,),
-                # 116: ("burner_starts", int_converter,),
-                # 117: ("ch_pump_starts", int_converter,),
-                # 118: ("dhw_pump_starts", int_converter,),
-                # 119: ("dhw_burner_starts", int_converter,),
-                # 120: ("burner_operation_hours", int_converter,),
-                # 121: ("ch_pump_operation_hours", int_converter,),
-                # 122: ("dhw_pump_valve_operation_hours", int_converter,),
-                # 123: ("dhw_burner_operation_hours", int_converter,)
+            def signed_converter(val):
+                return val - 0x10000 if val & 0x8000 else val
+
+            def pair_converter(val):
+                return (val >> 8, val & 0xFF)
+
+            def signed_pair_converter(val):
+                hb, lb = val >> 8, val & 0xFF
+                return (hb - 0x100 if hb & 0x80 else hb, lb - 0x100 if lb & 0x80 else lb)
+
+            typeConverters = {
+                "f8.8": float_converter,
+                "u16": int_converter,
+                "s16": signed_converter,
+                "u8/u8": pair_converter,
+                "s8/s8": signed_pair_converter,
+                "flag8/u8": pair_converter,
+                "flag8/flag8": pair_converter,
             }
-            openthermTypes = {
-                0: "Read-Data     ",
-                1: "Write-Data    ",
-                2: "Invalid-Data  ",
-                3: "-reserved-    ",
-                4: "Read-Ack      ",
-                5: "Write-Ack     ",
-                6: "Invalid-Ack   ",
-                7: "Unknown-DataId"
+
+            # data id -> (name, type, access as in the OpenTherm 2.2 id table, names of the high and
+            # low byte of a pair type); access documents the spec, decoding does not depend on it;
+            # the name is also the MQTT topic, bytes without a name are not published
+            openthermIds = {
+                0: ("status", "flag8/flag8", "R", ("master", "slave")),
+                1: ("control_setpoint", "f8.8", "W", None),
+                2: ("master_config", "flag8/u8", "W", ("flags", "member_id")),
+                3: ("slave_config", "flag8/u8", "R", ("flags", "member_id")),
+                4: ("remote_command", "u8/u8", "RW", ("request", "response")),
+                5: ("fault_flags", "flag8/u8", "R", ("application", "oem_code")),
+                6: ("remote_parameter_flags", "flag8/flag8", "R", ("transfer_enable", "read_write")),
+                7: ("cooling_control", "f8.8", "W", None),
+                8: ("control_setpoint_2", "f8.8", "W", None),
+                9: ("remote_override_setpoint", "f8.8", "R", None),
+                10: ("tsp_count", "u8/u8", "R", ("count", None)),
+                11: ("tsp_entry", "u8/u8", "RW", ("index", "value")),
+                12: ("fault_history_size", "u8/u8", "R", ("size", None)),
+                13: ("fault_history_entry", "u8/u8", "R", ("index", "value")),
+                14: ("max_relative_modulation_level", "f8.8", "W", None),
+                15: ("max_capacity_min_modulation", "u8/u8", "R", ("max_capacity", "min_modulation")),
+                16: ("room_setpoint", "f8.8", "W", None),
+                17: ("relative_modulation_level", "f8.8", "R", None),
+                18: ("ch_water_pressure", "f8.8", "R", None),
+                19: ("dhw_flow_rate", "f8.8", "R", None),
+                20: ("day_time", "u8/u8", "RW", ("day_hour", "minutes")),
+                21: ("date", "u8/u8", "RW", ("month", "day")),
+                22: ("year", "u16", "RW", None),
+                23: ("room_setpoint_2", "f8.8", "W", None),
+                24: ("room_temperature", "f8.8", "W", None),
+                25: ("boiler_water_temperature", "f8.8", "R", None),
+                26: ("dhw_temperature", "f8.8", "R", None),
+                27: ("outside_temperature", "f8.8", "R", None),
+                28: ("return_water_temperature", "f8.8", "R", None),
+                29: ("solar_storage_temperature", "f8.8", "R", None),
+                30: ("solar_collector_temperature", "s16", "R", None),
+                31: ("flow_temperature_ch2", "f8.8", "R", None),
+                32: ("dhw2_temperature", "f8.8", "R", None),
+                33: ("exhaust_temperature", "s16", "R", None),
+                48: ("dhw_setpoint_bounds", "s8/s8", "R", ("max", "min")),
+                49: ("max_ch_setpoint_bounds", "s8/s8", "R", ("max", "min")),
+                50: ("otc_heat_curve_bounds", "s8/s8", "R", ("max", "min")),
+                56: ("dhw_setpoint", "f8.8", "RW", None),
+                57: ("max_ch_water_setpoint", "f8.8", "RW", None),
+                58: ("otc_heat_curve_ratio", "f8.8", "RW", None),
+                70: ("ventilation_status", "flag8/flag8", "R", ("master", "slave")),
+                71: ("ventilation_control_setpoint", "u8/u8", "W", (None, "setpoint")),
+                72: ("ventilation_fault_flags", "flag8/u8", "R", ("application", "oem_code")),
+                73: ("ventilation_oem_diagnostic_code", "u16", "R", None),
+                74: ("ventilation_config", "flag8/u8", "R", ("flags", "member_id")),
+                75: ("ventilation_opentherm_version", "f8.8", "R", None),
+                76: ("ventilation_product_version", "u8/u8", "R", ("type", "version")),
+                77: ("relative_ventilation", "u8/u8", "R", (None, "level")),
+                78: ("relative_humidity_exhaust", "u8/u8", "RW", (None, "level")),
+                79: ("co2_level_exhaust", "u16", "RW", None),
+                80: ("supply_inlet_temperature", "f8.8", "R", None),
+                81: ("supply_outlet_temperature", "f8.8", "R", None),
+                82: ("exhaust_inlet_temperature", "f8.8", "R", None),
+                83: ("exhaust_outlet_temperature", "f8.8", "R", None),
+                84: ("exhaust_fan_speed", "u16", "R", None),
+                85: ("supply_fan_speed", "u16", "R", None),
+                86: ("ventilation_remote_parameter_flags", "flag8/flag8", "R", ("transfer_enable", "read_write")),
+                87: ("nominal_ventilation", "u8/u8", "RW", ("value", None)),
+                88: ("ventilation_tsp_count", "u8/u8", "R", ("count", None)),
+                89: ("ventilation_tsp_entry", "u8/u8", "RW", ("index", "value")),
+                90: ("ventilation_fault_history_size", "u8/u8", "R", ("size", None)),
+                91: ("ventilation_fault_history_entry", "u8/u8", "R", ("index", "value")),
+                100: ("remote_override_function", "flag8/flag8", "R", (None, "function")),
+                115: ("oem_diagnostic_code", "u16", "R", None),
+                116: ("burner_starts", "u16", "RW", None),
+                117: ("ch_pump_starts", "u16", "RW", None),
+                118: ("dhw_pump_starts", "u16", "RW", None),
+                119: ("dhw_burner_starts", "u16", "RW", None),
+                120: ("burner_operation_hours", "u16", "RW", None),
+                121: ("ch_pump_operation_hours", "u16", "RW", None),
+                122: ("dhw_pump_valve_operation_hours", "u16", "RW", None),
+                123: ("dhw_burner_operation_hours", "u16", "RW", None),
+                124: ("master_opentherm_version", "f8.8", "W", None),
+                125: ("slave_opentherm_version", "f8.8", "R", None),
+                126: ("master_product_version", "u8/u8", "W", ("type", "version")),
+                127: ("slave_product_version", "u8/u8", "R", ("type", "version")),
             }
+            # status (id 0) bits as (byte, mask, name): byte 0 is the master's flags in the high
+            # byte of the request, byte 1 the slave's flags in the low byte of the response
+            statusFlags = (
+                (0, 0x01, "ch_enable"),
+                (0, 0x02, "dhw_enable"),
+                (0, 0x04, "cooling_enable"),
+                (0, 0x08, "otc_active"),
+                (0, 0x10, "ch2_enable"),
+                (0, 0x20, "summer_mode"),
+                (0, 0x40, "dhw_blocking"),
+                (1, 0x01, "fault"),
+                (1, 0x02, "ch_active"),
+                (1, 0x04, "dhw_active"),
+                (1, 0x08, "flame"),
+                (1, 0x10, "cooling_active"),
+                (1, 0x20, "ch2_active"),
+                (1, 0x40, "diagnostic"),
+            )
+
+            # decoding plans indexed by data id, built once so decoding is a list lookup
+            dataIdTable = [("Unknown", int_converter,)] * 256
+            dataIdFields = [None] * 256
+            for _dataId, (_name, _type, _access, _fields) in openthermIds.items():
+                dataIdTable[_dataId] = (_name, typeConverters[_type])
+                dataIdFields[_dataId] = _fields
+            del _dataId, _name, _type, _access, _fields
+
+            openthermTypes = (
+                "Read-Data     ",
+                "Write-Data    ",
+                "Invalid-Data  ",
+                "-reserved-    ",
+                "Read-Ack      ",
+                "Write-Ack     ",
+                "Invalid-Ack   ",
+                "Unknown-DataId"
+            )
+            # raw frame text is only kept when debugging, decoded fields are enough otherwise
+            keepLine = False
+
+            __slots__ = ("line", "src", "msgType", "dataId", "data", "dataIdName", "value")
+
             def __init__(self, line, src, msgType, dataId, data):
-                self.line = line.rstrip()
+                self.line = line.rstrip() if self.keepLine else None
                 self.src = src
                 self.msgType = msgType
                 self.dataId = dataId
                 self.data = data
-                self.msgTypeName = self.openthermTypes[self.msgType]
-                if self.dataId in self.openthermIds:
-                    dataIdName, converter = self.openthermIds[self.dataId]
-                    self.dataIdName = dataIdName;
-                    self.value = converter(val = self.data)
-                else:
-                    self.dataIdName = "Unknown"
-                    self.value = data
+                self.dataIdName, converter = self.dataIdTable[dataId]
+                self.value = converter(data)
+
+            @property
+            def msgTypeName(self):
+                return self.openthermTypes[self.msgType]
+
             def __repr__(self):
+                if self.line is None:
+                    return "MessageLine: {} {} {} ({}) {}".format(self.src, self.msgTypeName, self.dataIdName, self.dataId, self.value)
                 return "MessageLine ({}): {} {} {} ({}) {}".format(self.line, self.src, self.msgTypeName, self.dataIdName, self.dataId, self.value)
 
-        messageParser = re.compile(r'^(?P<source>[BART])(?P<type>[0-9A-F])(?P<res>[0-9A-F])(?P<id>[0-9A-F]{2})(?P<data>[0-9A-F]{4})$')
-        dataId = None
-        thermostatSrc = None # T
-        boilerDst = None # R
-        boilerSrc = None # B
-        thermostatDst = None # A
-        srcValue = None
-        dstValue = None
-        ready = False
-        msg = None
-        def hex_int(self, hex):
-            return int(hex, 16)
+        @staticmethod
+        def decodeFrame(line):
+            # fixed-offset decoding of a 9 char T/B/R/A frame: source letter followed by
+            # 32 bits of hex (type nibble, reserved nibble, data id byte, data word)
+            if len(line) != 9:
+                if len(line) == 10 and line[9] == '\n':
+                    line = line[:9]
+                else:
+                    return None
+            src = line[0]
+            frame = line[1:]
+            if src not in "BART" or not hexDigits.issuperset(frame):
+                return None
+            frame = int(frame, 16)
+            return (src, (frame >> 28) & 7, (frame >> 16) & 0xFF, frame & 0xFFFF)
+
+        __slots__ = ("dataId", "thermostatSrc", "boilerDst", "boilerSrc", "thermostatDst", "ready", "msg", "updated")
+
+        def __init__(self):
+            self.dataId = None
+            self.thermostatSrc = None # T
+            self.boilerDst = None # R
+            self.boilerSrc = None # B
+            self.thermostatDst = None # A
+            self.ready = False
+            self.msg = None
+            self.updated = None
+
+        def finish(self):
+            self.ready = True
+            if self.thermostatSrc and self.thermostatSrc.dataIdName != "Unknown":
+                self.msg = self.thermostatSrc.dataIdName
+
+        # ids whose boiler answer the gateway may replace without rewriting the request
+        # (remote override setpoint and function for TT/TC, outside temperature for OT)
+        substitutedIds = frozenset((9, 27, 100))
+
+        # a transaction is complete when no more legs are expected: the gateway answers the
+        # thermostat itself (A) when it rewrote the request (R), the boiler did not know the id,
+        # or for a substituted id, so those wait for A or the leg timeout
+        def complete(self):
+            if self.thermostatDst:
+                return True
+            if not self.boilerSrc or not self.thermostatSrc:
+                return False
+            return not self.boilerDst and self.boilerSrc.msgType != 7 and self.dataId not in self.substitutedIds
+
         def processLine(self, msgLine):
-            info = self.messageParser.match(msgLine)
-            if info is None:
+            frame = self.decodeFrame(msgLine)
+            if frame is None:
                 return False
-            (src, msgType, nop, dataId, data) = map(lambda f, d: f(d),
-                (str, lambda _: self.hex_int(_) & 7, self.hex_int, self.hex_int, self.hex_int),
-                info.groups())
-            messageLine = self.MessageLine(msgLine, src, msgType, dataId, data)
+            messageLine = self.MessageLine(msgLine, *frame)
 
             if self.dataId != None and self.dataId != messageLine.dataId:
-                self.ready = True
-                if self.thermostatSrc and self.thermostatSrc.dataIdName != "Unknown":
-                    self.msg = self.thermostatSrc.dataIdName
+                self.finish()
                 return False #it's not from this message line
 
             self.dataId = messageLine.dataId
@@ -128,15 +269,39 @@ class OTGW:
             "NF": "Not Found",
             "OE": "Overrun Error",
         }
+        # lower goes first, heating and hot water switches are safety relevant
+        commandPriorities = {
+            "CH": 0,
+            "HW": 0,
+            "CS": 1,
+            "SW": 1,
+            "TT": 2,
+            "TC": 2,
+            "OT": 2,
+        }
+        defaultPriority = 1
         command = None
         sent = False
         success = False
         result = None
         error = None
         processed = False
-        def __init__(self, commandLine):
+        attempts = 0
+        sequence = None
+        # seconds from queueing to the first write, and from the last write to its response
+        queueWait = None
+        roundTrip = None
+        def __init__(self, commandLine, priority=None, expires=None):
             self.command = commandLine.rstrip()
             self.commandWord = commandLine.split("=")[0]
+            self.priority = self.commandPriorities.get(self.commandWord, self.defaultPriority) if priority is None else priority
+            self.expires = expires
+            self.queued = time.time()
+
+        def written(self, now):
+            self.sent = now
+            if self.queueWait is None:
+                self.queueWait = now - self.queued
         def processLine(self, msgLine):
             if self.sent and msgLine.startswith(self.commandWord+":"):
                 self.result = msgLine.rstrip()
@@ -151,31 +316,172 @@ class OTGW:
                 return True
             return False
 
+        def reset(self):
+            self.sent = False
+            self.success = False
+            self.result = None
+            self.error = None
+            self.processed = False
+
+        # ends the command without a gateway response
+        def drop(self, result, error):
+            self.result = result
+            self.error = error
+            self.success = False
+            self.processed = True
+
         def __repr__(self):
             return "Command ({})\n\tResult: {}\n\tError:{}".format(self.command, self.result, self.error)
 
 
-    commandQueue = deque([])
-    lastCommand = None
+    legTimeout = 0.5
+    commandTimeout = 2
+    commandQueueSize = 32
+    commandMaxAge = 30
+    maxRetries = 3
+    retryBackoff = 0.1
+    retriedErrors = ("SE", "NG")
+    # command word -> (data id, message leg) whose last decoded value shows the command is in effect;
+    # the remote override is what the gateway answers the thermostat, setpoints are what the boiler acked
+    commandEffects = {
+        "TT": ("remote_override_setpoint", "thermostatDst"),
+        "CS": ("control_setpoint", "boilerSrc"),
+        "SW": ("dhw_setpoint", "boilerSrc"),
+    }
+    # command word -> data id name it writes; once such a command is applied, the last decoded
+    # value of that id no longer shows what any command writing the same id would change
+    commandWrites = {
+        "TT": "remote_override_setpoint",
+        "TC": "remote_override_setpoint",
+        "CS": "control_setpoint",
+        "SW": "dhw_setpoint",
+    }
+    stateMaxAge = 60
+    suppressUnchanged = True
+    clock = staticmethod(time.monotonic)
 
-    def send_command(self, command):
+    def __init__(self, name="otgw"):
+        self.name = name
+        self.commandQueue = CommandScheduler(self.commandQueueSize)
+        self.lastCommand = None
+        # commands that ended without a gateway response since the last takeDroppedCommands
+        self.droppedCommands = []
+        # data id name -> (clock, message) of the last decoded transaction
+        self.state = {}
+        # data id name -> clock of the last successful command that wrote it
+        self.commandApplied = {}
+        self.lastMessage = self.Message()
+        self.framesParsed = registry.counter("otgw_frames_parsed_total", "OpenTherm frames decoded", gateway=name)
+        self.messagesUnknown = registry.counter("otgw_unknown_messages_total", "Messages with an unsupported data id", gateway=name)
+        self.linesUnsupported = registry.counter("otgw_unsupported_lines_total", "Gateway lines that are neither a frame nor a command response", gateway=name)
+        self.commandRetries = {error: registry.counter("otgw_command_retries_total", "Commands repeated after an error or timeout",
+            gateway=name, reason=error) for error in self.retriedErrors}
+        self.commandTimeouts = registry.counter("otgw_command_retries_total", "Commands repeated after an error or timeout", gateway=name, reason="timeout")
+        self.commandLatency = {}
+
+    def send_command(self, command, priority=None, maxAge=None):
         log.info("Queueing command: '{}'".format(command))
-        self.commandQueue.append(self.Command(command))
+        queued = self.Command(command, priority, time.time() + (self.commandMaxAge if maxAge is None else maxAge))
+        if self.suppressUnchanged and self.inEffect(queued):
+            log.info("Skipping command {}: already in effect".format(queued.command))
+            queued.drop("unchanged", "Already in effect")
+            self.__count(queued)
+            self.droppedCommands.append(queued)
+        else:
+            self.__queue(queued)
+        return queued
+
+    # true when the decoded state already shows the value the command sets, and no command writing
+    # the same data id is pending or was applied after that state was decoded
+    def inEffect(self, command):
+        effect = self.commandEffects.get(command.commandWord)
+        if effect is None or self.__writePending(effect[0]):
+            return False
+        decoded, message = self.state.get(effect[0], (None, None))
+        if message is None or self.clock() - decoded > self.stateMaxAge \
+                or decoded <= self.commandApplied.get(effect[0], decoded - 1):
+            return False
+        # a missing leg says nothing, e.g. no A leg means no override is answered
+        leg = getattr(message, effect[1])
+        try:
+            return leg is not None and leg.msgType in (4, 5) and abs(leg.value - float(command.command.partition("=")[2])) < 0.01
+        except ValueError:
+            return False
+
+    def __writePending(self, dataId):
+        for code, written in self.commandWrites.items():
+            if written == dataId and (code in self.commandQueue
+                    or (self.lastCommand and self.lastCommand.commandWord == code)):
+                return True
+        return False
+
+    def takeDroppedCommands(self):
+        dropped, self.droppedCommands = self.droppedCommands, []
+        return dropped
+
+    def __queue(self, command, notBefore=0):
+        for removed, reason in self.commandQueue.push(command, notBefore):
+            if reason == "superseded":
+                self.__drop(removed, reason, "Superseded by a newer {} command".format(removed.commandWord))
+            else:
+                self.__drop(removed, reason, "Command queue full")
+
+    def __drop(self, command, result, error):
+        log.warning("Dropping command {}: {}".format(command.command, error))
+        command.drop(result, error)
+        self.__count(command)
+        self.droppedCommands.append(command)
 
-    lastMessage = Message()
-    seCount = 0
+    def __count(self, command):
+        registry.counter("otgw_commands_total", "Commands answered by the gateway", gateway=self.name,
+            result="ok" if command.success else command.result).inc()
+        if command.queueWait is not None:
+            self.__latency(command.commandWord)[0].observe(command.queueWait)
+
+    # (queue wait, round trip) histograms of a command code
+    def __latency(self, code):
+        latency = self.commandLatency.get(code)
+        if latency is None:
+            latency = self.commandLatency[code] = (
+                registry.histogram("otgw_command_queue_wait_seconds", "Time from queueing a command to writing it",
+                    gateway=self.name, code=code),
+                registry.histogram("otgw_command_round_trip_seconds", "Time from writing a command to its response",
+                    gateway=self.name, code=code))
+        return latency
+
+    # queues the command again after an exponential backoff while attempts and its deadline allow
+    def __retry(self, command, reason):
+        now = time.time()
+        if command.attempts >= self.maxRetries or now >= command.expires:
+            return False
+        command.attempts += 1
+        reason.inc()
+        log.warning("Repeat command ({}): {}".format(command.attempts, command.command))
+        command.reset()
+        self.__queue(command, now + self.retryBackoff * 2 ** (command.attempts - 1))
+        return True
 
     def processLine(self, line):
 
         #process message
         processed = self.lastMessage.processLine(line)
-        if self.lastMessage.ready: #message ready
+        if self.lastMessage.ready: #message ended without all of its legs
             readyMessage = self.lastMessage
             self.lastMessage = self.Message()
             processed = self.lastMessage.processLine(line)
-            log.debug(readyMessage)
+            if processed:
+                self.framesParsed.inc()
+                self.lastMessage.updated = self.clock()
             if readyMessage.thermostatSrc: # prevent first not full message
-                return readyMessage
+                return self.__ready(readyMessage)
+        elif processed:
+            self.framesParsed.inc()
+            if self.lastMessage.complete():
+                readyMessage = self.lastMessage
+                self.lastMessage = self.Message()
+                readyMessage.finish()
+                return self.__ready(readyMessage)
+            self.lastMessage.updated = self.clock()
 
         #process command
         if not processed and self.lastCommand:
@@ -183,23 +489,86 @@ class OTGW:
             if self.lastCommand.processed:
                 readyCommand = self.lastCommand
                 self.lastCommand = None
-                if (not readyCommand.success) and readyCommand.result == "SE" and self.seCount < 3:
-                    self.seCount = self.seCount + 1
-                    self.sendCommand(readyCommand.commandLine)
-                    log.warning("Repeat command ({}): {}".format(self.seCount, readyCommand.commandLine))
-                else:
-                    self.seCount = 0
+                readyCommand.roundTrip = time.time() - readyCommand.sent
+                self.__latency(readyCommand.commandWord)[1].observe(readyCommand.roundTrip)
+                if readyCommand.success and readyCommand.commandWord in self.commandWrites:
+                    self.commandApplied[self.commandWrites[readyCommand.commandWord]] = self.clock()
+                if readyCommand.success or readyCommand.result not in self.retriedErrors \
+                        or not self.__retry(readyCommand, self.commandRetries[readyCommand.result]):
+                    self.__count(readyCommand)
+                # the gateway is free for the next command, a retried one comes back unprocessed
                 return readyCommand
 
-        if (not self.lastCommand) and self.commandQueue.__len__() > 0:
-            self.lastCommand = self.commandQueue.pop()
-            return self.lastCommand
-
-        if self.lastCommand and self.lastCommand.sent and time.time() - self.lastCommand.sent > 2 :
-            log.warning("No response in 2 sec for command: {}. Repeating.".format(self.lastCommand.command))
-            self.lastCommand.sent = False
-            return self.lastCommand
-
         if not processed and len(line.rstrip()) > 0:
+            self.linesUnsupported.inc()
             log.warning("Unsupported message: '{}'".format(line.rstrip()))
 
+    def __ready(self, message):
+        log.debug(message)
+        if not message.msg:
+            self.messagesUnknown.inc()
+        else:
+            self.state[message.msg] = (self.clock(), message)
+        return message
+
+    # hands out the message being assembled once no leg arrived for legTimeout seconds,
+    # so a missing R/B/A leg does not hold it back until the next data id
+    def expireMessage(self):
+        message = self.lastMessage
+        if message.updated is None or self.clock() - message.updated < self.legTimeout:
+            return None
+        self.lastMessage = self.Message()
+        message.finish()
+        if message.thermostatSrc:
+            return self.__ready(message)
+        return None
+
+    # seconds until expireMessage has something to do, None when no message is pending
+    def messageDeadline(self):
+        if self.lastMessage.updated is None:
+            return None
+        return max(0, self.lastMessage.updated + self.legTimeout - self.clock())
+
+    # next command to write to the gateway: a queued one when idle, or the current one
+    # when it has not been written yet (e.g. after a reconnect)
+    def pollCommand(self):
+        self.expireCommand()
+        if self.lastCommand:
+            return None if self.lastCommand.sent else self.lastCommand
+        self.lastCommand = self.commandQueue.pop(time.time())
+        return self.lastCommand
+
+    # drops queued commands past their deadline, as well as the current command when it waits
+    # unsent for a reconnect beyond its deadline, and queues the command in flight for a retry
+    # when its response did not arrive within commandTimeout
+    def expireCommand(self):
+        now = time.time()
+        for command in self.commandQueue.expire(now):
+            self.__drop(command, "expired", "Deadline passed")
+        command = self.lastCommand
+        if command and not command.sent and command.expires <= now:
+            self.lastCommand = None
+            self.__drop(command, "expired", "Deadline passed")
+            return None
+        if not command or not command.sent or now - command.sent < self.commandTimeout:
+            return None
+        log.warning("No response in {} sec for command: {}".format(self.commandTimeout, command.command))
+        self.lastCommand = None
+        command.reset()
+        if not self.__retry(command, self.commandTimeouts):
+            self.__drop(command, "timeout", "No response")
+        return command
+
+    # seconds until expireCommand or pollCommand have something new to do, None when nothing is waiting
+    def commandDeadline(self):
+        now = time.time()
+        deadline = self.commandQueue.nextEvent(now)
+        if self.lastCommand:
+            if self.lastCommand.sent:
+                timeout = self.lastCommand.sent + self.commandTimeout
+            else:
+                timeout = self.lastCommand.expires
+            deadline = timeout if deadline is None else min(deadline, timeout)
+        if deadline is None:
+            return None
+        return max(0, deadline - now)
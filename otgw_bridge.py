@@ -1,12 +1,14 @@
+import asyncio
+import json
 import logging
-import re
+from async_otgw_client import AsyncOTGWClient
 from otgw import OTGW
-from tcp_client import TcpClient
 from threading import Thread
-from otgw_bridge_config import config
-from oled_controller import OledController
 import paho.mqtt.client as mqtt
-import time
+from metrics import registry, PrometheusExporter
+from mqtt_publisher import BatchPublisher
+from publish_policy import PolicyPublisher
+from command_spec import commandSpecs, batchTopic, resultTopic, batchResultTopic, batch_commands, command_request
 
 logging.basicConfig(level=logging.INFO)
 
@@ -14,37 +16,110 @@ log = logging.getLogger(__name__)
 
 class OTGWBridge:
 
+    class Gateway:
+
+        def __init__(self, config, on_message):
+            self.name = config['name']
+            self.client = AsyncOTGWClient(config['host'], int(config['port']),
+                on_message=lambda message: on_message(self, message), name=self.name,
+                readSize=int(config.get('readSize', AsyncOTGWClient.defaultReadSize)))
+            self.valueTopicNamespace = config['value_topic_namespace']
+            self.setTopicNamespace = config['set_topic_namespace']
+            self.thermostatFirst = config.get('thermostatFirst', False)
+            # every status bit with its translated output for both states, a status frame only picks one per bit
+            self.statusTopics = []
+            for byte, mask, name in OTGW.Message.MessageLine.statusFlags:
+                topic = "{}/status/{}".format(self.valueTopicNamespace, name)
+                self.statusTopics.append((byte, mask, ("status", topic, "True"), ("status", topic, "False")))
+            self.lastThermostatValues = {}
+            self.oled = None
+            self.publisher = None
+            if config.get('oled'):
+                # the display is optional, so is its http dependency
+                from oled_controller import OledController
+                self.oled = OledController(config['oled']['host'])
+
+    @staticmethod
+    def gateway_configs(config):
+        if 'gateways' not in config:
+            # single gateway layout: the gateway owns the mqtt namespaces and the display
+            gateway = dict(config['otgw'])
+            gateway.setdefault('name', 'otgw')
+            gateway.setdefault('value_topic_namespace', config['mqtt']['value_topic_namespace'])
+            gateway.setdefault('set_topic_namespace', config['mqtt']['set_topic_namespace'])
+            gateway.setdefault('oled', config.get('oled'))
+            return [gateway]
+        gateways = []
+        for gatewayConfig in config['gateways']:
+            gateway = dict(gatewayConfig)
+            gateway.setdefault('value_topic_namespace', "{}/{}".format(config['mqtt']['value_topic_namespace'], gateway['name']))
+            gateway.setdefault('set_topic_namespace', "{}/{}".format(config['mqtt']['set_topic_namespace'], gateway['name']))
+            gateways.append(gateway)
+        return gateways
+
     def __init__(self, config):
-        self.__otgwClient = TcpClient(config['otgw']['host'], int(config['otgw']['port']))
-        self.__otgw = OTGW()
-        self.__otgw_worker_thread = None
         self.__config = config
-        self.__oled = OledController(config['oled']['host'])
+        self.__loop = asyncio.new_event_loop()
+        self.__gateway_thread = None
+        self.__gateways = []
+        for gatewayConfig in self.gateway_configs(config):
+            self.__gateways.append(self.Gateway(gatewayConfig, self.__on_otgw_message))
+        self.__mqttc = self.__create_mqtt_client()
+        self.__commandsRejected = registry.counter("mqtt_commands_rejected_total", "MQTT command payloads that failed validation")
+        self.__add_command_routes()
+        self.__publisher = BatchPublisher(self.__mqttc, config['mqtt']['qos'], config['mqtt']['retain'],
+            float(config['mqtt'].get('publish_window', 0)), self.__loop)
+        for gateway in self.__gateways:
+            gateway.publisher = PolicyPublisher(self.__publisher, config['mqtt'].get('publish_policy', {}), self.__loop, gateway.name)
+        self.__publishQueueDepth = registry.histogram("mqtt_publish_queue_depth", "Packets waiting in the MQTT client at publish time",
+            buckets=(0, 1, 2, 5, 10, 50, 100, 1000))
+        registry.gauge("mqtt_out_packets", "Packets waiting in the MQTT client", function=lambda: len(self.__mqttc._out_packet))
+        self.__exporter = None
+        if config.get('metrics'):
+            self.__exporter = PrometheusExporter(registry, config['metrics'].get('host', "0.0.0.0"), int(config['metrics']['port']))
 
     def run(self):
-        if self.__otgw_worker_thread:
+        if self.__exporter:
+            self.__exporter.start()
+        self.start_gateways()
+        self.__mqttc.connect(self.__config["mqtt"]["host"], self.__config["mqtt"]["port"])
+        self.__mqttc.loop_forever()
+
+    def start_gateways(self):
+        if self.__gateway_thread:
             raise RuntimeError("Already running")
-        self.__otgw_worker_thread = Thread(target=self.__otgw_worker)
-        self.__otgw_worker_thread.start()
-        self.__oled.start()
-        self.__run_mqtt()
+        self.__gateway_thread = Thread(target=self.__gateway_worker)
+        self.__gateway_thread.start()
+        for gateway in self.__gateways:
+            if gateway.oled:
+                gateway.oled.start()
+
+    def stop_gateways(self):
+        for gateway in self.__gateways:
+            self.__loop.call_soon_threadsafe(gateway.client.stop)
+        self.__gateway_thread.join()
+        self.__gateway_thread = None
+
+    def stop(self):
+        self.stop_gateways()
+        self.__mqttc.disconnect()
 
-    def __run_mqtt(self):
+    def __create_mqtt_client(self):
         def on_mqtt_connect(client, userdata, flags, rc):
-            # Subscribe to all topics in our namespace when we're connected. Send out
+            # Subscribe to all topics in our namespaces when we're connected. Send out
             # a message telling we're online
             log.info("Connected with result code " + str(rc))
-            client.subscribe('{}/#'.format(self.__config['mqtt']['set_topic_namespace']))
+            for gateway in self.__gateways:
+                client.subscribe('{}/#'.format(gateway.setTopicNamespace))
             client.publish(
                 topic=self.__config['mqtt']['value_topic_namespace'],
                 payload="online",
                 qos=self.__config['mqtt']['qos'],
                 retain=self.__config['mqtt']['retain'])
 
-        mqttc = mqtt.Client("otgw", clean_session=False)
+        mqttc = mqtt.Client(self.__config['mqtt'].get('client_id', "otgw"), clean_session=False)
         if self.__config['mqtt']['username']:
             mqttc.username_pw_set(self.__config["mqtt"]["username"], self.__config["mqtt"]["password"])
-        mqttc.connect(self.__config["mqtt"]["host"], self.__config["mqtt"]["port"])
 
         def on_disconnect(client, userdata, rc):
             if rc != 0:
@@ -58,112 +133,137 @@ class OTGWBridge:
             payload="offline",
             qos=self.__config['mqtt']['qos'],
             retain=True)
+        return mqttc
 
-        self.__mqttc = mqttc
-        mqttc.loop_forever()
+    # one callback per gateway and command topic, the client dispatches them through its topic trie
+    def __add_command_routes(self):
+        for gateway in self.__gateways:
+            for spec in commandSpecs:
+                self.__mqttc.message_callback_add(spec.topic_for(gateway.setTopicNamespace),
+                    lambda client, userdata, msg, gateway=gateway, spec=spec: self.__on_command_message(gateway, spec, msg))
+            self.__mqttc.message_callback_add(batchTopic.format(namespace=gateway.setTopicNamespace),
+                lambda client, userdata, msg, gateway=gateway: self.__on_batch_message(gateway, msg))
 
-    def __on_mqtt_message(self, client, userdata, msg):
-        log.debug("Received message on topic {} with payload {}".format(msg.topic, str(msg.payload)))
-        command_generators = {
-            "set/otgw/room_setpoint/temporary": lambda _: "TT={:.2f}".format(float(_)),
-            "set/otgw/room_setpoint/constant": lambda _: "TC={:.2f}".format(float(_)),
-            "set/otgw/control_setpoint/temperature": lambda _: "CS={:.2f}".format(float(_)),
-            "set/otgw/outside_temperature": lambda _: "OT={:.2f}".format(float(_)),
-            "set/otgw/hot_water/enable": lambda _: "HW={}".format('1' if _ in self.__true_values else '0'),
-            "set/otgw/hot_water/temperature": lambda _: "SW={:.2f}".format(float(_)),
-            "set/otgw/central_heating/enable": lambda _: "CH={}".format('1' if _ in self.__true_values else '0'),
+    def __on_command_message(self, gateway, spec, msg):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Received message on topic {} with payload {}".format(msg.topic, str(msg.payload)))
+        correlationId = None
+        try:
+            payload, correlationId = command_request(msg.payload)
+            command = spec.command(payload)
+        except ValueError as e:
+            self.__commandsRejected.inc()
+            log.warning("Ignoring {} on {}: {}".format(msg.payload, msg.topic, e))
+            self.__publish_result(gateway, resultTopic, {"correlation_id": correlationId, "code": spec.code,
+                "success": False, "result": "rejected", "error": str(e)})
+            return
+        # hand the command to the gateway's event loop
+        self.__loop.call_soon_threadsafe(self.__submit_command, gateway, command, correlationId)
+
+    def __submit_command(self, gateway, command, correlationId):
+        gateway.client.submit_command(command).add_done_callback(lambda future: self.__publish_result(
+            gateway, resultTopic, dict(self.command_result(future.result()), correlation_id=correlationId)))
+
+    # every command of a batch is validated before any is queued, one result covers all of them
+    def __on_batch_message(self, gateway, msg):
+        try:
+            commands, correlationId = batch_commands(msg.payload)
+        except ValueError as e:
+            self.__commandsRejected.inc()
+            log.warning("Ignoring batch on {}: {}".format(msg.topic, e))
+            self.__publish_result(gateway, batchResultTopic, {"success": False, "error": str(e), "results": []})
+            return
+        self.__loop.call_soon_threadsafe(self.__submit_batch, gateway, commands, correlationId)
+
+    def __submit_batch(self, gateway, commands, correlationId):
+        # queued in one go, the client writes each one as soon as the previous one is answered
+        def on_done(batch):
+            results = [self.command_result(command) for command in batch.result()]
+            self.__publish_result(gateway, batchResultTopic, {"correlation_id": correlationId,
+                "success": all(result["success"] for result in results), "results": results})
+
+        asyncio.gather(*[gateway.client.submit_command(command) for command in commands]).add_done_callback(on_done)
+
+    @staticmethod
+    def command_result(command):
+        return {
+            "command": command.command,
+            "code": command.commandWord,
+            # a command skipped because it is already in effect counts as applied
+            "success": command.success or command.result == "unchanged",
+            "result": command.result,
+            "error": command.error,
+            "attempts": command.attempts + 1,
+            "queue_wait": command.queueWait,
+            "round_trip": command.roundTrip,
         }
-        # Find the correct command generator from the dict above
-        command_generator = command_generators.get(msg.topic)
-        if command_generator:
-            # Get the command and send it to the OTGW
-            command = command_generator(msg.payload)
-            self.__otgw.send_command(command)
 
-    __true_values = ('True', 'true', '1', 'y', 'yes')
-    __lastThermostatValues = {}
+    def __publish_result(self, gateway, topic, result):
+        self.__mqttc.publish(
+            topic=topic.format(namespace=gateway.valueTopicNamespace),
+            payload=json.dumps(result),
+            qos=self.__config['mqtt']['qos'],
+            retain=False)
 
-    def __thermostat_first(self, msg):
+    def __on_mqtt_message(self, client, userdata, msg):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("No command for topic {} with payload {}".format(msg.topic, str(msg.payload)))
+
+    def __thermostat_first(self, gateway, msg):
         if msg.msg in ["dhw_setpoint", "control_setpoint"]:
-            if msg.msg in self.__lastThermostatValues and msg.thermostatSrc.value != self.__lastThermostatValues[msg.msg]:
+            if msg.msg in gateway.lastThermostatValues and msg.thermostatSrc.value != gateway.lastThermostatValues[msg.msg]:
                 if msg.msg == "dhw_setpoint":
                     command = "SW=0"
                 if msg.msg == "control_setpoint":
                     command = "CS=0"
-                self.__otgw.send_command(command)
-            self.__lastThermostatValues[msg.msg] = msg.thermostatSrc.value
+                gateway.client.submit_command(command)
+            gateway.lastThermostatValues[msg.msg] = msg.thermostatSrc.value
 
-    def __on_otgw_message(self, message):
-        if config["otgw"]["thermostatFirst"]:
-            self.__thermostat_first(message)
+    def __on_otgw_message(self, gateway, message):
+        if gateway.thermostatFirst:
+            self.__thermostat_first(gateway, message)
         # if message.msg:
         #     print(message)
-        for msg in self.__otgw_translate_message(message):
-            log.debug("Sending message to topic {} value {}".format(msg[1], msg[2]))
-            self.__mqttc.publish(
-                topic=msg[1],
-                payload=msg[2],
-                qos=config['mqtt']['qos'],
-                retain=config['mqtt']['retain'])
-
-    def __otgw_translate_message(self, message):
-        def extractBit(value, number):
-            rev = value[::-1]
-            try:
-                return str(rev[number] == "1")
-            except:
-                return str(False)
+        debug = log.isEnabledFor(logging.DEBUG)
+        for msg in self.__otgw_translate_message(gateway, message):
+            if debug:
+                log.debug("Sending message to topic {} value {}".format(msg[1], msg[2]))
+            gateway.publisher.add(msg[0], msg[1], msg[2])
+        self.__publishQueueDepth.observe(len(self.__mqttc._out_packet))
+        gateway.publisher.end_message()
+        if gateway.oled:
+            gateway.oled.on_otgw_message(msg=message)
+
+    def __otgw_translate_message(self, gateway, message):
         if message.msg and message.boilerSrc and message.thermostatSrc:
             msg = message.msg
-            topic = "{}/{}".format(self.__config['mqtt']['value_topic_namespace'], msg)
-            value = message.boilerSrc.value
-
             if msg == "status":
-                #value.
-                return iter([
-                    (msg, "{}/fault".format(topic), extractBit(value, 0)),
-                    (msg, "{}/ch_active".format(topic), extractBit(value, 1)),
-                    (msg, "{}/dhw_active".format(topic), extractBit(value, 2)),
-                    (msg, "{}/flame".format(topic), extractBit(value, 3)),
-                ])
-            else:
-                return iter([(msg, topic, value)])
+                # master flags as the boiler received them, slave flags from its response
+                flags = ((message.boilerDst or message.thermostatSrc).data >> 8, message.boilerSrc.data & 0xFF)
+                return iter([on if flags[byte] & mask else off for byte, mask, on, off in gateway.statusTopics])
+
+            topic = "{}/{}".format(gateway.valueTopicNamespace, msg)
+            value = message.boilerSrc.value
+            fields = OTGW.Message.MessageLine.dataIdFields[message.dataId]
+            if fields:
+                # pair types publish each named byte below the id's topic
+                return iter([(msg, "{}/{}".format(topic, field), byte) for field, byte in zip(fields, value) if field])
+            return iter([(msg, topic, value)])
         else:
             return iter([])
 
-    def __otgw_worker(self):
-        self._worker_running = True
-
-        line_regex = re.compile(r'^.*[\r\n]+')
-
-        buffer = ""
-        while self._worker_running:
-            buffer += self.__otgwClient.read()
-            # Find all the lines in the read data
-            while True:
-                m = line_regex.match(buffer)
-                if not m:
-                    break
-                line = m.group().rstrip('\r\n')
-                # log.info("Line: {}".format(line))
-                operation = self.__otgw.processLine(line)
-                if operation:
-                    try:
-                        if isinstance(operation, OTGW.Message):
-                            self.__on_otgw_message(message=operation)
-                            self.__oled.on_otgw_message(msg=operation)
-                        elif isinstance(operation, OTGW.Command):
-                            if not operation.processed:
-                                log.info("Sending command: '{}'".format(operation.command))
-                                self.__otgwClient.write(operation.command)
-                                operation.sent = time.time()
-                            else:
-                                log.info("Processed command: {}".format(operation))
-                    except Exception as e:
-                        log.warning(str(e))
-
-                # Strip the consumed line from the buffer
-                buffer = buffer[m.end():]
-
-        self._worker_thread = None
+    async def __log_stats(self):
+        while True:
+            await asyncio.sleep(60)
+            if log.isEnabledFor(logging.DEBUG):
+                for gateway in self.__gateways:
+                    log.debug("OTGW {} read stats: {}".format(gateway.name, gateway.client.stats()))
+
+    async def __run_gateways(self):
+        stats = asyncio.ensure_future(self.__log_stats())
+        await asyncio.gather(*[gateway.client.run() for gateway in self.__gateways])
+        stats.cancel()
 
+    def __gateway_worker(self):
+        asyncio.set_event_loop(self.__loop)
+        self.__loop.run_until_complete(self.__run_gateways())
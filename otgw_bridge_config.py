@@ -2,8 +2,16 @@ config = {
     "otgw" : {
         "host": "192.168.2.202",
         "port": "23",
-        "thermostatFirst": True
+        "thermostatFirst": True,
+        # bytes per socket read, one preallocated buffer per gateway connection
+        # "readSize": 4096
     },
+    # to serve several gateways from one process list them here instead of "otgw";
+    # each one publishes under value_topic_namespace/<name> and listens on set_topic_namespace/<name>
+    # "gateways": [
+    #     {"name": "boiler1", "host": "192.168.2.202", "port": "23", "thermostatFirst": True},
+    #     {"name": "boiler2", "host": "192.168.2.203", "port": "23", "thermostatFirst": False},
+    # ],
     "mqtt" : {
         "host": "192.168.2.20",
         "port": 1883,
@@ -12,8 +20,21 @@ config = {
         "value_topic_namespace": "value/otgw",
         "set_topic_namespace": "set/otgw",
         "qos": 0,
-        "retain": False
+        "retain": False,
+        # seconds to collect values from several OTGW messages into one MQTT write, 0 flushes per message
+        "publish_window": 0,
+        # per topic or OpenTherm id name ("default" for the rest): on_change, deadband,
+        # relative_deadband, min_interval and max_age (seconds); without it every value is published
+        # "publish_policy": {
+        #     "default": {"on_change": True, "max_age": 300},
+        #     "room_temperature": {"deadband": 0.1, "min_interval": 10},
+        #     "ch_water_pressure": {"relative_deadband": 0.02, "min_interval": 30},
+        # },
     },
+    # serve counters and histograms in Prometheus text format on http://<host>:<port>/metrics
+    # "metrics" : {
+    #     "port": 9105
+    # },
     "oled" : {
         "host": "192.168.2.202"
     }
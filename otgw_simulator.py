@@ -0,0 +1,210 @@
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import time
+
+log = logging.getLogger(__name__)
+
+
+class OTGWSimulator:
+
+    # command code -> value parser, anything the parser rejects is answered with BV
+    def float_value(val):
+        return "{:.2f}".format(float(val))
+
+    def flag_value(val):
+        if val not in ("0", "1"):
+            raise ValueError(val)
+        return val
+
+    commands = {
+        "TT": float_value,
+        "TC": float_value,
+        "CS": float_value,
+        "OT": float_value,
+        "SW": float_value,
+        "HW": flag_value,
+        "CH": flag_value,
+    }
+
+    # data id -> initial value of the synthesized T/B transactions
+    synthesizedIds = {
+        0: 0x0300,
+        1: 0x3C00,
+        9: 0x0000,
+        16: 0x1400,
+        18: 0x0180,
+        24: 0x1480,
+        25: 0x3700,
+        26: 0x2E00,
+        27: 0x0500,
+        28: 0x3200,
+        56: 0x2D00,
+        57: 0x5000,
+    }
+    # commands whose value shows up in a synthesized data id
+    commandIds = {"CS": 1, "SW": 56}
+    # commands the gateway answers the thermostat with itself: an A leg after the boiler's B,
+    # until the override is cancelled with 0
+    overrideIds = {"TT": 9, "TC": 9}
+
+    def __init__(self, host='127.0.0.1', port=0, rate=10, replay=None, errorRate=0.0, garbageRate=0.0,
+                 disconnectEvery=None, stallEvery=None, stallTime=3, responseDelay=0, dropRate=0.0):
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.errorRate = errorRate
+        self.garbageRate = garbageRate
+        self.disconnectEvery = disconnectEvery
+        self.stallEvery = stallEvery
+        self.stallTime = stallTime
+        self.responseDelay = responseDelay
+        self.dropRate = dropRate
+        self.values = dict(self.synthesizedIds)
+        self.overrides = {}
+        self.replay = None
+        if replay:
+            with open(replay) as f:
+                self.replay = [line.rstrip('\r\n') for line in f if line[:1] in "TBRA"]
+        self.__server = None
+        self.__writers = set()
+        self.__stalledUntil = 0
+        self.connections = 0
+        self.disconnectedAt = None
+        self.reconnectTimes = []
+        self.commandsReceived = 0
+        self.commandTimes = []
+        self.linesSent = 0
+
+    @staticmethod
+    def frame(src, msgType, dataId, data):
+        frame = (msgType << 28) | (dataId << 16) | data
+        # even parity over the 32 bit frame lives in the top bit
+        if bin(frame).count("1") % 2:
+            frame |= 1 << 31
+        return "{}{:08X}".format(src, frame)
+
+    def synthesize(self):
+        while True:
+            for dataId in self.synthesizedIds:
+                yield self.frame('T', 0, dataId, 0)
+                yield self.frame('B', 4, dataId, self.values[dataId])
+                if dataId in self.overrides:
+                    yield self.frame('A', 4, dataId, self.overrides[dataId])
+
+    def answer(self, commandLine):
+        code, separator, value = commandLine.partition("=")
+        if not separator or len(code) != 2:
+            return "SE"
+        if code not in self.commands:
+            return "NG"
+        try:
+            value = self.commands[code](value)
+        except ValueError:
+            return "BV"
+        if self.errorRate and random.random() < self.errorRate:
+            return "SE"
+        if code in self.commandIds:
+            self.values[self.commandIds[code]] = int(round(float(value) * 256)) & 0xFFFF
+        if code in self.overrideIds:
+            if float(value):
+                self.overrides[self.overrideIds[code]] = int(round(float(value) * 256)) & 0xFFFF
+            else:
+                self.overrides.pop(self.overrideIds[code], None)
+        return "{}: {}".format(code, value)
+
+    async def start(self):
+        self.__server = await asyncio.start_server(self.__handle, self.host, self.port)
+        self.port = self.__server.sockets[0].getsockname()[1]
+        log.info("OTGW simulator listening on {}:{}".format(self.host, self.port))
+        return self
+
+    async def serve_forever(self):
+        await self.start()
+        await self.__server.serve_forever()
+
+    def close(self):
+        self.__server.close()
+        self.disconnect()
+
+    # drop every client connection, the time until the next connect is recorded in reconnectTimes
+    def disconnect(self):
+        for writer in list(self.__writers):
+            writer.close()
+        self.disconnectedAt = time.perf_counter()
+
+    def stall(self, seconds):
+        self.__stalledUntil = time.perf_counter() + seconds
+
+    async def __handle(self, reader, writer):
+        if self.disconnectedAt is not None:
+            self.reconnectTimes.append(time.perf_counter() - self.disconnectedAt)
+            self.disconnectedAt = None
+        self.connections += 1
+        self.__writers.add(writer)
+        traffic = asyncio.ensure_future(self.__traffic(writer))
+        try:
+            while True:
+                line = await reader.readuntil(b'\r')
+                self.commandsReceived += 1
+                self.commandTimes.append(time.perf_counter())
+                if self.dropRate and random.random() < self.dropRate:
+                    continue
+                response = self.answer(line.decode('ascii', 'replace').strip())
+                if self.responseDelay:
+                    await asyncio.sleep(self.responseDelay)
+                writer.write("{}\r\n".format(response).encode())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            traffic.cancel()
+            self.__writers.discard(writer)
+            writer.close()
+
+    async def __traffic(self, writer):
+        lines = itertools.cycle(self.replay) if self.replay else self.synthesize()
+        tick = min(0.1, 1.0 / self.rate) if self.rate else 0.1
+        start = time.perf_counter()
+        due = 0.0
+        while True:
+            await asyncio.sleep(tick)
+            now = time.perf_counter()
+            if self.disconnectEvery and now - start > self.disconnectEvery:
+                log.info("Simulating disconnect")
+                self.disconnect()
+                return
+            if self.stallEvery and (now - start) % self.stallEvery < tick:
+                self.stall(self.stallTime)
+            if now < self.__stalledUntil:
+                continue
+            due += self.rate * tick
+            count = int(due)
+            due -= count
+            if count:
+                writer.write("".join("{}\r\n".format(next(lines)) for _ in range(count)).encode())
+                self.linesSent += count
+            if self.garbageRate and random.random() < self.garbageRate:
+                writer.write(os.urandom(random.randint(1, 32)))
+            await writer.drain()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OTGW gateway simulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7686)
+    parser.add_argument("--rate", type=float, default=10, help="frames per second")
+    parser.add_argument("--replay", help="replay T/B/R/A frames from this file instead of synthesizing them")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of commands answered with SE")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="share of commands left unanswered")
+    parser.add_argument("--garbage-rate", type=float, default=0.0, help="chance per tick of writing random bytes")
+    parser.add_argument("--disconnect-every", type=float, help="drop the connection after this many seconds")
+    parser.add_argument("--stall-every", type=float, help="stop sending frames every this many seconds")
+    parser.add_argument("--stall-time", type=float, default=3)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    simulator = OTGWSimulator(args.host, args.port, args.rate, args.replay, args.error_rate, args.garbage_rate,
+                              args.disconnect_every, args.stall_every, args.stall_time, dropRate=args.drop_rate)
+    asyncio.run(simulator.serve_forever())
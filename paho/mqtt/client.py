@@ -37,6 +37,7 @@ import uuid
 import base64
 import string
 import hashlib
+import heapq
 import logging
 
 try:
@@ -516,13 +517,16 @@ class Client(object):
         self._password = None
         self._in_packet = {
             "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
             "remaining_length": 0,
             "packet": b"",
-            "to_process": 0,
             "pos": 0}
+        self._in_buffer = bytearray()
+        self._in_read_size = 65536
+        self._out_batch_packets = 64
+        self._out_batch_bytes = 65536
+        # validated publish topics: topic -> (encoded topic, length prefixed topic)
+        self._topic_cache = {}
+        self._topic_cache_size = 256
         self._out_packet = collections.deque()
         self._current_out_packet = None
         self._last_msg_in = time_func()
@@ -533,8 +537,13 @@ class Client(object):
         self._ping_t = 0
         self._last_mid = 0
         self._state = mqtt_cs_new
-        self._out_messages = []
-        self._in_messages = []
+        # in flight messages by mid, in the order they were published
+        self._out_messages = collections.OrderedDict()
+        self._in_messages = collections.OrderedDict()
+        # (timestamp, mid) of messages waiting for the broker, earliest first; an
+        # entry whose message is gone or has a newer timestamp is skipped
+        self._out_retries = []
+        self._in_retries = []
         self._max_inflight_messages = 20
         self._inflight_messages = 0
         self._max_queued_messages = 0
@@ -859,13 +868,10 @@ class Client(object):
 
         self._in_packet = {
             "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
             "remaining_length": 0,
             "packet": b"",
-            "to_process": 0,
             "pos": 0}
+        self._in_buffer = bytearray()
 
         with self._out_packet_mutex:
             self._out_packet = collections.deque()
@@ -1008,9 +1014,11 @@ class Client(object):
             # Stimulate output write even though we didn't ask for it, because
             # at that point the publish or other command wasn't present.
             socklist[1].insert(0, self._sock)
-            # Clear sockpairR - only ever a single byte written.
+            # Clear sockpairR - one byte is written per queued packet, and the
+            # write below handles every packet queued so far, so all pending
+            # wakeups are consumed at once.
             try:
-                self._sockpairR.recv(1)
+                self._sockpairR.recv(4096)
             except socket.error as err:
                 if err.errno != EAGAIN:
                     raise
@@ -1056,36 +1064,18 @@ class Client(object):
         A ValueError will be raised if topic is None, has zero length or is
         invalid (contains a wildcard), if qos is not one of 0, 1 or 2, or if
         the length of the payload is greater than 268435455 bytes."""
-        if topic is None or len(topic) == 0:
-            raise ValueError('Invalid topic.')
-
-        topic = topic.encode('utf-8')
-
-        if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
-            raise ValueError('Publish topic cannot contain wildcards.')
+        topic, topic_field = self._publish_topic(topic)
 
         if qos < 0 or qos > 2:
             raise ValueError('Invalid QoS level.')
 
-        if isinstance(payload, unicode):
-            local_payload = payload.encode('utf-8')
-        elif isinstance(payload, (bytes, bytearray)):
-            local_payload = payload
-        elif isinstance(payload, (int, float)):
-            local_payload = str(payload).encode('ascii')
-        elif payload is None:
-            local_payload = b''
-        else:
-            raise TypeError('payload must be a string, bytearray, int, float or None.')
-
-        if len(local_payload) > 268435455:
-            raise ValueError('Payload too large.')
+        local_payload = self._encode_payload(payload)
 
         local_mid = self._mid_generate()
 
         if qos == 0:
             info = MQTTMessageInfo(local_mid)
-            rc = self._send_publish(local_mid, topic, local_payload, qos, retain, False, info)
+            rc = self._send_publish(local_mid, topic, local_payload, qos, retain, False, info, topic_field)
             info.rc = rc
             return info
         else:
@@ -1101,16 +1091,17 @@ class Client(object):
                     message.info.rc = MQTT_ERR_QUEUE_SIZE
                     return message.info
 
-                self._out_messages.append(message)
+                self._out_messages[message.mid] = message
                 if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
                     self._inflight_messages += 1
                     if qos == 1:
                         message.state = mqtt_ms_wait_for_puback
                     elif qos == 2:
                         message.state = mqtt_ms_wait_for_pubrec
+                    self._retry_schedule(self._out_retries, message)
 
                     rc = self._send_publish(message.mid, topic, message.payload, message.qos, message.retain,
-                                            message.dup)
+                                            message.dup, topic_field=topic_field)
 
                     # remove from inflight messages so it will be send after a connection is made
                     if rc is MQTT_ERR_NO_CONN:
@@ -1124,6 +1115,48 @@ class Client(object):
                     message.info.rc = MQTT_ERR_SUCCESS
                     return message.info
 
+    def publish_batch(self, messages):
+        """Publish several QoS 0 messages as a single queued packet.
+
+        All messages are encoded into one buffer which is queued with one
+        lock acquisition and one wakeup of the network loop, and is usually
+        written to the socket with a single send() call. This is meant for
+        publishers that produce a burst of small related messages at once.
+
+        messages: An iterable of (topic, payload, retain) tuples, with topic
+        and payload as accepted by publish().
+
+        Returns a list of MQTTMessageInfo, one per message in the same order.
+        Their rc is MQTT_ERR_NO_CONN if the client is not currently connected.
+        The on_publish() callback is called for every message once the whole
+        batch has been written.
+
+        A ValueError or TypeError is raised under the same conditions as for
+        publish(), in which case nothing is queued."""
+        packet = bytearray()
+        infos = []
+        for topic, payload, retain in messages:
+            topic_field = self._publish_topic(topic)[1]
+            local_payload = self._encode_payload(payload)
+
+            packet.append(PUBLISH | (1 if retain else 0))
+            self._pack_remaining_length(packet, len(topic_field) + len(local_payload))
+            packet.extend(topic_field)
+            packet.extend(local_payload)
+            infos.append(MQTTMessageInfo(self._mid_generate()))
+
+        if not infos:
+            return infos
+
+        if self._sock is None:
+            rc = MQTT_ERR_NO_CONN
+        else:
+            self._easy_log(MQTT_LOG_DEBUG, "Sending %d PUBLISH in one batch (%d bytes)", len(infos), len(packet))
+            rc = self._packet_queue(PUBLISH, packet, infos[0].mid, 0, infos)
+        for info in infos:
+            info.rc = rc
+        return infos
+
     def username_pw_set(self, username, password=None):
         """Set a username and optionally a password for broker authentication.
 
@@ -1311,6 +1344,9 @@ class Client(object):
                 return self._loop_rc_handle(rc)
             elif rc == MQTT_ERR_AGAIN:
                 return MQTT_ERR_SUCCESS
+            elif not self.want_write():
+                # _packet_write() writes everything that is queued
+                break
         return MQTT_ERR_SUCCESS
 
     def want_write(self):
@@ -1767,110 +1803,97 @@ class Client(object):
 
     def _packet_read(self):
         # This gets called if pselect() indicates that there is network data
-        # available - ie. at least one byte.  What we do depends on what data we
-        # already have.
-        # If we've not got a command, attempt to read one and save it. This should
-        # always work because it's only a single byte.
-        # Then try to read the remaining length. This may fail because it is may
-        # be more than one byte - will need to save data pending next read if it
-        # does fail.
-        # Then try to read the remaining payload, where 'payload' here means the
-        # combined variable header and actual payload. This is the most likely to
-        # fail due to longer length, so save current data and current position.
-        # After all data is read, send to _mqtt_handle_packet() to deal with.
-        # Finally, free the memory and reset everything to starting conditions.
-        if self._in_packet['command'] == 0:
-            try:
-                command = self._sock.recv(1)
-            except socket.error as err:
-                if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
-                    return MQTT_ERR_AGAIN
-                if err.errno == EAGAIN:
-                    return MQTT_ERR_AGAIN
-                print(err)
-                return 1
-            else:
-                if len(command) == 0:
-                    return 1
-                command, = struct.unpack("!B", command)
-                self._in_packet['command'] = command
-
-        if self._in_packet['have_remaining'] == 0:
-            # Read remaining
+        # available - ie. at least one byte.
+        # Read as much as the socket has, up to _in_read_size bytes, into the
+        # reusable input buffer, then hand every complete packet in the buffer
+        # to _packet_handle(). A partial packet stays buffered until the next
+        # call, so a burst of small packets costs one recv() instead of three
+        # or more per packet.
+        try:
+            data = self._sock.recv(self._in_read_size)
+        except socket.error as err:
+            if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
+                return MQTT_ERR_AGAIN
+            if err.errno == EAGAIN:
+                return MQTT_ERR_AGAIN
+            print(err)
+            return 1
+        if len(data) == 0:
+            return 1
+
+        buf = self._in_buffer
+        buf += data
+        end = len(buf)
+        pos = 0
+        rc = MQTT_ERR_SUCCESS
+        while end - pos >= 2:
+            # Remaining length: up to four bytes of seven bits, least significant first.
             # Algorithm for decoding taken from pseudo code at
             # http://publib.boulder.ibm.com/infocenter/wmbhelp/v6r0m0/topic/com.ibm.etools.mft.doc/ac10870_.htm
+            remaining_length = 0
+            mult = 1
+            start = pos + 1
             while True:
-                try:
-                    byte = self._sock.recv(1)
-                except socket.error as err:
-                    if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
-                        return MQTT_ERR_AGAIN
-                    if err.errno == EAGAIN:
-                        return MQTT_ERR_AGAIN
-                    print(err)
-                    return 1
-                else:
-                    if len(byte) == 0:
-                        return 1
-                    byte, = struct.unpack("!B", byte)
-                    self._in_packet['remaining_count'].append(byte)
-                    # Max 4 bytes length for remaining length as defined by protocol.
-                    # Anything more likely means a broken/malicious client.
-                    if len(self._in_packet['remaining_count']) > 4:
-                        return MQTT_ERR_PROTOCOL
-
-                    self._in_packet['remaining_length'] += (byte & 127) * self._in_packet['remaining_mult']
-                    self._in_packet['remaining_mult'] = self._in_packet['remaining_mult'] * 128
-
+                if start == end:
+                    remaining_length = None
+                    break
+                byte = buf[start]
+                start += 1
+                remaining_length += (byte & 127) * mult
+                mult *= 128
                 if (byte & 128) == 0:
                     break
+                # Max 4 bytes length for remaining length as defined by protocol.
+                # Anything more likely means a broken/malicious client.
+                if start - pos > 4:
+                    return MQTT_ERR_PROTOCOL
+            if remaining_length is None or end - start < remaining_length:
+                break
 
-            self._in_packet['have_remaining'] = 1
-            self._in_packet['to_process'] = self._in_packet['remaining_length']
-
-        while self._in_packet['to_process'] > 0:
-            try:
-                data = self._sock.recv(self._in_packet['to_process'])
-            except socket.error as err:
-                if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
-                    return MQTT_ERR_AGAIN
-                if err.errno == EAGAIN:
-                    return MQTT_ERR_AGAIN
-                print(err)
-                return 1
-            else:
-                if len(data) == 0:
-                    return 1
-                self._in_packet['to_process'] -= len(data)
-                self._in_packet['packet'] += data
-
-        # All data for this packet is read.
-        self._in_packet['pos'] = 0
-        rc = self._packet_handle()
-
-        # Free data and reset values
-        self._in_packet = {
-            'command': 0,
-            'have_remaining': 0,
-            'remaining_count': [],
-            'remaining_mult': 1,
-            'remaining_length': 0,
-            'packet': b"",
-            'to_process': 0,
-            'pos': 0}
+            self._in_packet['command'] = buf[pos]
+            self._in_packet['remaining_length'] = remaining_length
+            self._in_packet['packet'] = bytes(buf[start:start + remaining_length])
+            self._in_packet['pos'] = 0
+            pos = start + remaining_length
+            rc = self._packet_handle()
+            if rc or self._in_buffer is not buf:
+                # an error, or a callback reconnected and the rest belongs to the old connection
+                break
 
-        with self._msgtime_mutex:
-            self._last_msg_in = time_func()
+        if pos:
+            del buf[:pos]
+            with self._msgtime_mutex:
+                self._last_msg_in = time_func()
         return rc
 
     def _packet_write(self):
         self._current_out_packet_mutex.acquire()
 
         while self._current_out_packet:
-            packet = self._current_out_packet
+            # Write the current packet together with the packets queued behind it
+            # in one call: scatter/gather where the socket supports it, otherwise
+            # one coalesced buffer. A partially written packet resumes from a
+            # memoryview offset instead of a copied slice.
+            packets = [self._current_out_packet]
+            if self._out_packet:
+                size = self._current_out_packet['to_process']
+                with self._out_packet_mutex:
+                    for packet in self._out_packet:
+                        if len(packets) == self._out_batch_packets or size >= self._out_batch_bytes \
+                                or (packets[-1]['command'] & 0xF0) == DISCONNECT:
+                            break
+                        packets.append(packet)
+                        size += packet['to_process']
+            buffers = [memoryview(packet['packet'])[packet['pos']:] if packet['pos'] else packet['packet']
+                       for packet in packets]
 
             try:
-                write_length = self._sock.send(packet['packet'][packet['pos']:])
+                if len(buffers) == 1:
+                    write_length = self._sock.send(buffers[0])
+                elif not self._ssl and hasattr(self._sock, 'sendmsg'):
+                    write_length = self._sock.sendmsg(buffers)
+                else:
+                    write_length = self._sock.send(b"".join(buffers))
             except (AttributeError, ValueError):
                 self._current_out_packet_mutex.release()
                 return MQTT_ERR_SUCCESS
@@ -1883,41 +1906,63 @@ class Client(object):
                 print(err)
                 return 1
 
-            if write_length > 0:
-                packet['to_process'] -= write_length
-                packet['pos'] += write_length
-
-                if packet['to_process'] == 0:
-                    if (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
-                        with self._callback_mutex:
-                            if self.on_publish:
-                                with self._in_callback:
-                                    self.on_publish(self, self._userdata, packet['mid'])
+            if write_length <= 0:
+                break
 
-                        packet['info']._set_as_published()
+            completed = 0
+            published = []
+            for packet in packets:
+                written = min(write_length, packet['to_process'])
+                write_length -= written
+                packet['to_process'] -= written
+                packet['pos'] += written
+                if packet['to_process'] > 0:
+                    break
+                completed += 1
+                if (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
+                    # packets queued by publish_batch() carry one info per message
+                    if isinstance(packet['info'], list):
+                        published.extend(packet['info'])
+                    else:
+                        published.append(packet['info'])
+
+            if published:
+                with self._callback_mutex:
+                    if self.on_publish:
+                        with self._in_callback:
+                            for info in published:
+                                self.on_publish(self, self._userdata, info.mid)
+                for info in published:
+                    info._set_as_published()
 
-                    if (packet['command'] & 0xF0) == DISCONNECT:
-                        self._current_out_packet_mutex.release()
+            # a DISCONNECT is always the last packet of a write
+            if completed and (packets[completed - 1]['command'] & 0xF0) == DISCONNECT:
+                self._current_out_packet_mutex.release()
 
-                        with self._msgtime_mutex:
-                            self._last_msg_out = time_func()
+                with self._msgtime_mutex:
+                    self._last_msg_out = time_func()
 
-                        with self._callback_mutex:
-                            if self.on_disconnect:
-                                with self._in_callback:
-                                    self.on_disconnect(self, self._userdata, 0)
+                with self._callback_mutex:
+                    if self.on_disconnect:
+                        with self._in_callback:
+                            self.on_disconnect(self, self._userdata, 0)
 
-                        if self._sock:
-                            self._sock.close()
-                            self._sock = None
-                        return MQTT_ERR_SUCCESS
+                if self._sock:
+                    self._sock.close()
+                    self._sock = None
+                return MQTT_ERR_SUCCESS
 
-                    with self._out_packet_mutex:
-                        if len(self._out_packet) > 0:
-                            self._current_out_packet = self._out_packet.popleft()
-                        else:
-                            self._current_out_packet = None
-            else:
+            if completed:
+                # the written packets after the current one are still at the head of the queue
+                with self._out_packet_mutex:
+                    for _ in range(completed - 1):
+                        self._out_packet.popleft()
+                    if len(self._out_packet) > 0:
+                        self._current_out_packet = self._out_packet.popleft()
+                    else:
+                        self._current_out_packet = None
+            if completed < len(packets):
+                # the socket buffer is full, wait for the next writable event
                 break
 
         self._current_out_packet_mutex.release()
@@ -1971,6 +2016,27 @@ class Client(object):
             self._last_mid = 1
         return self._last_mid
 
+    def _publish_topic(self, topic):
+        # The encoded topic and its length prefixed packet field. Topics are
+        # validated and encoded once and then kept, a publisher usually sends
+        # to the same few topics over and over.
+        cached = self._topic_cache.get(topic)
+        if cached is not None:
+            return cached
+
+        if topic is None or len(topic) == 0:
+            raise ValueError('Invalid topic.')
+
+        encoded = topic.encode('utf-8')
+
+        if self._topic_wildcard_len_check(encoded) != MQTT_ERR_SUCCESS:
+            raise ValueError('Publish topic cannot contain wildcards.')
+
+        cached = (encoded, struct.pack("!H", len(encoded)) + encoded)
+        if len(self._topic_cache) < self._topic_cache_size:
+            self._topic_cache[topic] = cached
+        return cached
+
     @staticmethod
     def _topic_wildcard_len_check(topic):
         # Search for + or # in a topic. Return MQTT_ERR_INVAL if found.
@@ -2010,6 +2076,10 @@ class Client(object):
         return self._send_command_with_mid(PUBCOMP, mid, False)
 
     def _pack_remaining_length(self, packet, remaining_length):
+        if remaining_length < 128:
+            packet.append(remaining_length)
+            return packet
+
         remaining_bytes = []
         while True:
             byte = remaining_length % 128
@@ -2030,7 +2100,24 @@ class Client(object):
         packet.extend(struct.pack("!H", len(data)))
         packet.extend(data)
 
-    def _send_publish(self, mid, topic, payload=b'', qos=0, retain=False, dup=False, info=None):
+    def _encode_payload(self, payload):
+        if isinstance(payload, unicode):
+            local_payload = payload.encode('utf-8')
+        elif isinstance(payload, (bytes, bytearray)):
+            local_payload = payload
+        elif isinstance(payload, (int, float)):
+            local_payload = str(payload).encode('ascii')
+        elif payload is None:
+            local_payload = b''
+        else:
+            raise TypeError('payload must be a string, bytearray, int, float or None.')
+
+        if len(local_payload) > 268435455:
+            raise ValueError('Payload too large.')
+
+        return local_payload
+
+    def _send_publish(self, mid, topic, payload=b'', qos=0, retain=False, dup=False, info=None, topic_field=None):
         # we assume that topic and payload are already properly encoded
         assert not isinstance(topic, unicode) and not isinstance(payload, unicode) and payload is not None
 
@@ -2062,7 +2149,10 @@ class Client(object):
             remaining_length += 2
 
         self._pack_remaining_length(packet, remaining_length)
-        self._pack_str16(packet, topic)
+        if topic_field is None:
+            self._pack_str16(packet, topic)
+        else:
+            packet.extend(topic_field)
 
         if qos > 0:
             # For message id
@@ -2191,39 +2281,50 @@ class Client(object):
         self._easy_log(MQTT_LOG_DEBUG, "Sending UNSUBSCRIBE (d%d) %s", dup, topics)
         return (self._packet_queue(command, packet, local_mid, 1), local_mid)
 
-    def _message_retry_check_actual(self, messages, mutex):
+    def _retry_schedule(self, retries, message):
+        heapq.heappush(retries, (message.timestamp, message.mid))
+
+    def _message_retry_check_actual(self, messages, retries, mutex):
         with mutex:
             now = time_func()
-            for m in messages:
-                if m.timestamp + self._message_retry < now:
-                    if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
-                        m.timestamp = now
-                        m.dup = True
-                        self._send_publish(
-                            m.mid,
-                            m.topic.encode('utf-8'),
-                            m.payload,
-                            m.qos,
-                            m.retain,
-                            m.dup
-                        )
-                    elif m.state == mqtt_ms_wait_for_pubrel:
-                        m.timestamp = now
-                        m.dup = True
-                        self._send_pubrec(m.mid)
-                    elif m.state == mqtt_ms_wait_for_pubcomp:
-                        m.timestamp = now
-                        m.dup = True
-                        self._send_pubrel(m.mid, True)
+            # retries are ordered by timestamp, only the messages that are due are looked at
+            while retries and retries[0][0] + self._message_retry < now:
+                timestamp, mid = heapq.heappop(retries)
+                m = messages.get(mid)
+                if m is None or m.timestamp != timestamp:
+                    continue
+                if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
+                    m.timestamp = now
+                    m.dup = True
+                    self._send_publish(
+                        m.mid,
+                        m.topic.encode('utf-8'),
+                        m.payload,
+                        m.qos,
+                        m.retain,
+                        m.dup
+                    )
+                elif m.state == mqtt_ms_wait_for_pubrel:
+                    m.timestamp = now
+                    m.dup = True
+                    self._send_pubrec(m.mid)
+                elif m.state == mqtt_ms_wait_for_pubcomp:
+                    m.timestamp = now
+                    m.dup = True
+                    self._send_pubrel(m.mid, True)
+                else:
+                    # rescheduled when it is sent again
+                    continue
+                self._retry_schedule(retries, m)
 
     def _message_retry_check(self):
-        self._message_retry_check_actual(self._out_messages, self._out_message_mutex)
-        self._message_retry_check_actual(self._in_messages, self._in_message_mutex)
+        self._message_retry_check_actual(self._out_messages, self._out_retries, self._out_message_mutex)
+        self._message_retry_check_actual(self._in_messages, self._in_retries, self._in_message_mutex)
 
     def _messages_reconnect_reset_out(self):
         with self._out_message_mutex:
             self._inflight_messages = 0
-            for m in self._out_messages:
+            for m in self._out_messages.values():
                 m.timestamp = 0
                 if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
                     if m.qos == 0:
@@ -2247,13 +2348,13 @@ class Client(object):
 
     def _messages_reconnect_reset_in(self):
         with self._in_message_mutex:
-            for m in self._in_messages:
+            for m in list(self._in_messages.values()):
                 m.timestamp = 0
                 if m.qos != 2:
-                    self._in_messages.pop(self._in_messages.index(m))
+                    del self._in_messages[m.mid]
                 else:
                     # Preserve current state
-                    pass
+                    self._retry_schedule(self._in_retries, m)
 
     def _messages_reconnect_reset(self):
         self._messages_reconnect_reset_out()
@@ -2374,7 +2475,7 @@ class Client(object):
         if result == 0:
             rc = 0
             with self._out_message_mutex:
-                for m in self._out_messages:
+                for m in self._out_messages.values():
                     m.timestamp = time_func()
                     if m.state == mqtt_ms_queued:
                         self.loop_write()  # Process outgoing messages that have just been queued up
@@ -2396,6 +2497,7 @@ class Client(object):
                         if m.state == mqtt_ms_publish:
                             self._inflight_messages += 1
                             m.state = mqtt_ms_wait_for_puback
+                            self._retry_schedule(self._out_retries, m)
                             with self._in_callback:  # Don't call loop_write after _send_publish()
                                 rc = self._send_publish(
                                     m.mid,
@@ -2411,6 +2513,7 @@ class Client(object):
                         if m.state == mqtt_ms_publish:
                             self._inflight_messages += 1
                             m.state = mqtt_ms_wait_for_pubrec
+                            self._retry_schedule(self._out_retries, m)
                             with self._in_callback:  # Don't call loop_write after _send_publish()
                                 rc = self._send_publish(
                                     m.mid,
@@ -2425,6 +2528,7 @@ class Client(object):
                         elif m.state == mqtt_ms_resend_pubrel:
                             self._inflight_messages += 1
                             m.state = mqtt_ms_wait_for_pubcomp
+                            self._retry_schedule(self._out_retries, m)
                             with self._in_callback:  # Don't call loop_write after _send_publish()
                                 rc = self._send_pubrel(m.mid, m.dup)
                             if rc != 0:
@@ -2507,8 +2611,9 @@ class Client(object):
             rc = self._send_pubrec(message.mid)
             message.state = mqtt_ms_wait_for_pubrel
             with self._in_message_mutex:
-                if message not in self._in_messages:
-                    self._in_messages.append(message)
+                if message.mid not in self._in_messages:
+                    self._in_messages[message.mid] = message
+                    self._retry_schedule(self._in_retries, message)
             return rc
         else:
             return MQTT_ERR_PROTOCOL
@@ -2521,27 +2626,26 @@ class Client(object):
         self._easy_log(MQTT_LOG_DEBUG, "Received PUBREL (Mid: %d)", mid)
 
         with self._in_message_mutex:
-            for i in range(len(self._in_messages)):
-                if self._in_messages[i].mid == mid:
-
-                    # Only pass the message on if we have removed it from the queue - this
-                    # prevents multiple callbacks for the same message.
-                    self._handle_on_message(self._in_messages[i])
-                    self._in_messages.pop(i)
-                    self._inflight_messages -= 1
-                    if self._max_inflight_messages > 0:
-                        with self._out_message_mutex:
-                            rc = self._update_inflight()
-                        if rc != MQTT_ERR_SUCCESS:
-                            return rc
+            message = self._in_messages.get(mid)
+            if message is not None:
+                # Only pass the message on if we have removed it from the queue - this
+                # prevents multiple callbacks for the same message.
+                self._handle_on_message(message)
+                del self._in_messages[mid]
+                self._inflight_messages -= 1
+                if self._max_inflight_messages > 0:
+                    with self._out_message_mutex:
+                        rc = self._update_inflight()
+                    if rc != MQTT_ERR_SUCCESS:
+                        return rc
 
-                    return self._send_pubcomp(mid)
+                return self._send_pubcomp(mid)
 
         return MQTT_ERR_SUCCESS
 
     def _update_inflight(self):
         # Dont lock message_mutex here
-        for m in self._out_messages:
+        for m in self._out_messages.values():
             if self._inflight_messages < self._max_inflight_messages:
                 if m.qos > 0 and m.state == mqtt_ms_queued:
                     self._inflight_messages += 1
@@ -2549,6 +2653,7 @@ class Client(object):
                         m.state = mqtt_ms_wait_for_puback
                     elif m.qos == 2:
                         m.state = mqtt_ms_wait_for_pubrec
+                    self._retry_schedule(self._out_retries, m)
                     rc = self._send_publish(
                         m.mid,
                         m.topic.encode('utf-8'),
@@ -2571,11 +2676,12 @@ class Client(object):
         self._easy_log(MQTT_LOG_DEBUG, "Received PUBREC (Mid: %d)", mid)
 
         with self._out_message_mutex:
-            for m in self._out_messages:
-                if m.mid == mid:
-                    m.state = mqtt_ms_wait_for_pubcomp
-                    m.timestamp = time_func()
-                    return self._send_pubrel(mid, False)
+            m = self._out_messages.get(mid)
+            if m is not None:
+                m.state = mqtt_ms_wait_for_pubcomp
+                m.timestamp = time_func()
+                self._retry_schedule(self._out_retries, m)
+                return self._send_pubrel(mid, False)
 
         return MQTT_ERR_SUCCESS
 
@@ -2591,13 +2697,13 @@ class Client(object):
                     self.on_unsubscribe(self, self._userdata, mid)
         return MQTT_ERR_SUCCESS
 
-    def _do_on_publish(self, idx, mid):
+    def _do_on_publish(self, mid):
         with self._callback_mutex:
             if self.on_publish:
                 with self._in_callback:
                     self.on_publish(self, self._userdata, mid)
 
-        msg = self._out_messages.pop(idx)
+        msg = self._out_messages.pop(mid)
         if msg.qos > 0:
             self._inflight_messages -= 1
             if self._max_inflight_messages > 0:
@@ -2615,16 +2721,10 @@ class Client(object):
         self._easy_log(MQTT_LOG_DEBUG, "Received %s (Mid: %d)", cmd, mid)
 
         with self._out_message_mutex:
-            for i in range(len(self._out_messages)):
-                try:
-                    if self._out_messages[i].mid == mid:
-                        # Only inform the client the message has been sent once.
-                        rc = self._do_on_publish(i, mid)
-                        return rc
-                except IndexError:
-                    # Have removed item so i>count.
-                    # Not really an error.
-                    pass
+            if mid in self._out_messages:
+                # Only inform the client the message has been sent once.
+                rc = self._do_on_publish(mid)
+                return rc
 
         return MQTT_ERR_SUCCESS
 
@@ -2637,7 +2737,7 @@ class Client(object):
                 topic = None
 
             if topic is not None:
-                for callback in self._on_message_filtered.iter_match(message.topic):
+                for callback in self._on_message_filtered.iter_match(topic):
                     with self._in_callback:
                         callback(self, self._userdata, message)
                     matched = True
@@ -2700,6 +2800,7 @@ class WebsocketWrapper(object):
         self._readbuffer = bytearray()
 
         self._requested_size = 0
+        self._frame = None
         self._payload_head = 0
         self._readbuffer_head = 0
 
@@ -2791,12 +2892,23 @@ class WebsocketWrapper(object):
         self._readbuffer = bytearray()
         self.connected = True
 
+    @staticmethod
+    def _mask(mask_key, data, offset=0):
+        # XOR the data with the repeated 4 byte key in one operation on big
+        # integers instead of byte by byte. offset is the position of data[0]
+        # in the frame payload, the key is rotated to match.
+        length = len(data)
+        if length == 0:
+            return bytearray()
+        offset %= 4
+        key = (mask_key[offset:] + mask_key[:offset]) * (length // 4 + 1)
+        masked = int.from_bytes(data, 'big') ^ int.from_bytes(key[:length], 'big')
+        return bytearray(masked.to_bytes(length, 'big'))
+
     def _create_frame(self, opcode, data, do_masking=1):
 
         header = bytearray()
         length = len(data)
-        mask_key = bytearray(
-            [random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)])
         mask_flag = do_masking
 
         # 1 << 7 is the final flag, we don't send continuated data
@@ -2817,89 +2929,116 @@ class WebsocketWrapper(object):
             raise ValueError("Maximum payload size is 2^63")
 
         if mask_flag == 1:
-            for index in range(length):
-                data[index] ^= mask_key[index % 4]
-            data = mask_key + data
+            mask_key = struct.pack("!I", random.getrandbits(32))
+            header += mask_key
+            data = self._mask(mask_key, data)
 
         return header + data
 
-    def _buffered_read(self, length):
+    def _buffered_fill(self, length):
 
-        # try to recv and strore needed bytes
-        wanted_bytes = length - (len(self._readbuffer) - self._readbuffer_head)
-        if wanted_bytes > 0:
+        # make length bytes available in the read buffer with at most one
+        # recv() of the missing part, returns how many are available
+        available = len(self._readbuffer) - self._readbuffer_head
+        if available < length:
 
-            data = self._socket.recv(wanted_bytes)
+            data = self._socket.recv(length - available)
 
             if not data:
                 raise socket.error(errno.ECONNABORTED, 0)
-            else:
-                self._readbuffer.extend(data)
 
-            if len(data) < wanted_bytes:
-                raise socket.error(errno.EAGAIN, 0)
+            self._readbuffer.extend(data)
+            available += len(data)
+
+        return available
+
+    def _buffered_read(self, length):
 
-        self._readbuffer_head += length
-        return self._readbuffer[self._readbuffer_head - length:self._readbuffer_head]
+        # consume length buffered bytes, the buffer is compacted in place
+        # instead of being sliced into a new one
+        head = self._readbuffer_head
+        data = self._readbuffer[head:head + length]
+        head += length
+        if head >= len(self._readbuffer):
+            del self._readbuffer[:]
+            head = 0
+        elif head >= 4096:
+            del self._readbuffer[:head]
+            head = 0
+        self._readbuffer_head = head
+        return data
+
+    def _read_frame_header(self):
+
+        if self._buffered_fill(2) < 2:
+            raise socket.error(errno.EAGAIN, 0)
+
+        head = self._readbuffer_head
+        header1 = self._readbuffer[head]
+        header2 = self._readbuffer[head + 1]
+
+        maskbit = (header2 & 0x80) == 0x80
+        lengthbits = (header2 & 0x7f)
+        header_length = 2 + (4 if maskbit else 0)
+        if lengthbits == 0x7e:
+            header_length += 2
+        elif lengthbits == 0x7f:
+            header_length += 8
+
+        # a short frame arrives with its header in the same recv()
+        wanted = header_length
+        if lengthbits < 0x7e:
+            wanted += lengthbits
+        if self._buffered_fill(wanted) < header_length:
+            raise socket.error(errno.EAGAIN, 0)
+
+        header = self._buffered_read(header_length)
+        payload_length = lengthbits
+        if lengthbits == 0x7e:
+            payload_length, = struct.unpack_from("!H", header, 2)
+        elif lengthbits == 0x7f:
+            payload_length, = struct.unpack_from("!Q", header, 2)
+
+        mask_key = bytes(header[-4:]) if maskbit else None
+        return header1 & 0x0f, payload_length, mask_key
 
     def _recv_impl(self, length):
 
         # try to decode websocket payload part from data
         try:
 
-            self._readbuffer_head = 0
+            # the header is parsed once per frame, the payload is then read in
+            # chunks of at most length bytes
+            if self._frame is None:
+                self._frame = self._read_frame_header()
+            opcode, payload_length, mask_key = self._frame
 
-            result = None
-
-            chunk_startindex = self._payload_head
-            chunk_endindex = self._payload_head + length
-
-            header1 = self._buffered_read(1)
-            header2 = self._buffered_read(1)
-
-            opcode = (header1[0] & 0x0f)
-            maskbit = (header2[0] & 0x80) == 0x80
-            lengthbits = (header2[0] & 0x7f)
-            payload_length = lengthbits
-            mask_key = None
-
-            # read length
-            if lengthbits == 0x7e:
-
-                value = self._buffered_read(2)
-                payload_length, = struct.unpack("!H", value)
-
-            elif lengthbits == 0x7f:
-
-                value = self._buffered_read(8)
-                payload_length, = struct.unpack("!Q", value)
-
-            # read mask
-            if maskbit:
-                mask_key = self._buffered_read(4)
-
-            # if frame payload is shorter than the requested data, read only the possible part
-            readindex = chunk_endindex
-            if payload_length < readindex:
-                readindex = payload_length
-
-            if readindex > 0:
-                # get payload chunk
-                payload = self._buffered_read(readindex)
-
-                # unmask only the needed part
-                if maskbit:
-                    for index in range(chunk_startindex, readindex):
-                        payload[index] ^= mask_key[index % 4]
-
-                result = payload[chunk_startindex:readindex]
-                self._payload_head = readindex
+            remaining = payload_length - self._payload_head
+            if opcode == WebsocketWrapper.OPCODE_BINARY:
+                wanted = min(length, remaining)
+                try:
+                    available = self._buffered_fill(wanted)
+                except socket.error:
+                    # return what is buffered, the rest of the frame is still
+                    # on its way and makes the socket readable again
+                    available = len(self._readbuffer) - self._readbuffer_head
+                    if available == 0:
+                        raise
+                readindex = min(wanted, available)
             else:
-                payload = bytearray()
-
-            # check if full frame arrived and reset readbuffer and payloadhead if needed
-            if readindex == payload_length:
-                self._readbuffer = bytearray()
+                # other frames are handled as a whole
+                if self._buffered_fill(remaining) < remaining:
+                    raise socket.error(errno.EAGAIN, 0)
+                readindex = remaining
+
+            payload = self._buffered_read(readindex)
+            if mask_key is not None:
+                payload = self._mask(mask_key, payload, self._payload_head)
+            self._payload_head += readindex
+
+            # check if full frame arrived and reset the frame state if needed
+            if self._payload_head == payload_length:
+                self._frame = None
                 self._payload_head = 0
 
                 # respond to non-binary opcodes, their arrival is not guaranteed beacause of non-blocking sockets
@@ -2911,8 +3050,8 @@ class WebsocketWrapper(object):
                     frame = self._create_frame(WebsocketWrapper.OPCODE_PONG, payload, 0)
                     self._socket.send(frame)
 
-            if opcode == WebsocketWrapper.OPCODE_BINARY:
-                return result
+            if opcode == WebsocketWrapper.OPCODE_BINARY and readindex > 0:
+                return payload
             else:
                 raise socket.error(errno.EAGAIN, 0)
 
@@ -2930,14 +3069,14 @@ class WebsocketWrapper(object):
         # if previous frame was sent successfully
         if len(self._sendbuffer) == 0:
             # create websocket frame
-            frame = self._create_frame(WebsocketWrapper.OPCODE_BINARY, bytearray(data))
+            frame = self._create_frame(WebsocketWrapper.OPCODE_BINARY, data)
             self._sendbuffer.extend(frame)
             self._requested_size = len(data)
 
         # try to write out as much as possible
         length = self._socket.send(self._sendbuffer)
 
-        self._sendbuffer = self._sendbuffer[length:]
+        del self._sendbuffer[:length]
 
         if len(self._sendbuffer) == 0:
             # buffer sent out completely, return with payload's size
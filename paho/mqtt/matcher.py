@@ -58,21 +58,29 @@ class MQTTMatcher(object):
         """Return an iterator on all values associated with filters 
         that match the :topic"""
         lst = topic.split('/')
+        last = len(lst)
         normal = not topic.startswith('$')
-        def rec(node, i=0):
-            if i == len(lst):
-                if node._content is not None:
-                    yield node._content
-            else:
-                part = lst[i]
-                if part in node._children:
-                    for content in rec(node._children[part], i + 1):
-                        yield content
-                if '+' in node._children and (normal or i > 0):
-                    for content in rec(node._children['+'], i + 1):
-                        yield content
-            if '#' in node._children and (normal or i > 0):
-                content = node._children['#']._content
-                if content is not None:
-                    yield content
-        return rec(self._root)
+        def walk():
+            # depth first with an explicit stack: exact matches, then '+', then '#',
+            # entries with a negative level are values of '#' filters to yield
+            stack = [(self._root, 0)]
+            while stack:
+                node, i = stack.pop()
+                if i < 0:
+                    yield node
+                    continue
+                children = node._children
+                if '#' in children and (normal or i > 0):
+                    content = children['#']._content
+                    if content is not None:
+                        stack.append((content, -1))
+                if i == last:
+                    if node._content is not None:
+                        yield node._content
+                    continue
+                if '+' in children and (normal or i > 0):
+                    stack.append((children['+'], i + 1))
+                child = children.get(lst[i])
+                if child is not None:
+                    stack.append((child, i + 1))
+        return walk()
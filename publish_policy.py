@@ -0,0 +1,102 @@
+import logging
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+
+class PublishPolicy:
+    __slots__ = ("onChange", "deadband", "relativeDeadband", "minInterval", "maxAge")
+
+    def __init__(self, onChange=False, deadband=0, relativeDeadband=0, minInterval=0, maxAge=0):
+        self.onChange = onChange
+        self.deadband = deadband
+        self.relativeDeadband = relativeDeadband
+        self.minInterval = minInterval
+        self.maxAge = maxAge
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('on_change', False), float(config.get('deadband', 0)),
+                   float(config.get('relative_deadband', 0)), float(config.get('min_interval', 0)),
+                   float(config.get('max_age', 0)))
+
+    def changed(self, last, value):
+        if isinstance(value, (int, float)) and isinstance(last, (int, float)):
+            threshold = max(self.deadband, self.relativeDeadband * abs(last))
+            if threshold:
+                return abs(value - last) > threshold
+        return value != last
+
+    def filters(self):
+        return self.onChange or self.deadband or self.relativeDeadband
+
+
+class PolicyPublisher:
+
+    class TopicState:
+        __slots__ = ("policy", "value", "time", "pending", "timer")
+
+        def __init__(self, policy):
+            self.policy = policy
+            self.value = None
+            self.time = None
+            self.pending = None
+            self.timer = None
+
+    # policies are looked up by topic first, then by OpenTherm data id name, then "default";
+    # without any policy every value is passed through
+    def __init__(self, publisher, policies, loop, name="otgw"):
+        self.__publisher = publisher
+        self.__loop = loop
+        self.__policies = {key: PublishPolicy.from_config(config) for key, config in policies.items()}
+        self.__default = self.__policies.pop("default", PublishPolicy())
+        self.__topics = {}
+        self.__published = registry.counter("mqtt_publishes_total", "Values published to MQTT", gateway=name)
+        self.__unchanged = registry.counter("mqtt_publishes_suppressed_total", "Values not published because of the publish policy",
+            gateway=name, reason="unchanged")
+        self.__deadband = registry.counter("mqtt_publishes_suppressed_total", "Values not published because of the publish policy",
+            gateway=name, reason="deadband")
+        self.__rateLimited = registry.counter("mqtt_publishes_suppressed_total", "Values not published because of the publish policy",
+            gateway=name, reason="min_interval")
+
+    def add(self, key, topic, value):
+        state = self.__topics.get(topic)
+        if state is None:
+            policy = self.__policies.get(topic) or self.__policies.get(key) or self.__default
+            state = self.__topics[topic] = self.TopicState(policy)
+        policy = state.policy
+        if state.time is not None:
+            now = self.__loop.time()
+            if policy.filters() and not policy.changed(state.value, value) \
+                    and not (policy.maxAge and now - state.time >= policy.maxAge):
+                if value == state.value:
+                    self.__unchanged.inc()
+                else:
+                    self.__deadband.inc()
+                # a newer value inside the deadband makes a deferred one obsolete
+                state.pending = None
+                return
+            if policy.minInterval and now - state.time < policy.minInterval:
+                self.__rateLimited.inc()
+                state.pending = (value,)
+                if state.timer is None:
+                    state.timer = self.__loop.call_later(state.time + policy.minInterval - now, self.__flush_pending, topic)
+                return
+        self.__publish(state, topic, value)
+
+    def end_message(self):
+        self.__publisher.end_message()
+
+    def __publish(self, state, topic, value):
+        state.value = value
+        state.time = self.__loop.time()
+        state.pending = None
+        self.__published.inc()
+        self.__publisher.add(topic, value)
+
+    def __flush_pending(self, topic):
+        state = self.__topics[topic]
+        state.timer = None
+        if state.pending is not None:
+            self.__publish(state, topic, state.pending[0])
+            self.__publisher.end_message()
@@ -1,15 +1,19 @@
 from otgw import OTGW
-from tcp_client import TcpClient
 import logging
+import time
 
 logging.basicConfig(level=logging.DEBUG)
 
 
+OTGW.Message.MessageLine.keepLine = True
 otgw = OTGW()
 
-otgw.sendCommand("HW=12")
+otgw.send_command("HW=12")
+otgw.pollCommand().written(time.time())
 
 for line in open('test-data/baxi-roca2.txt'):
     operation = otgw.processLine(line)
     if operation:
+        if isinstance(operation, OTGW.Command) and not operation.processed:
+            operation.written(time.time())
         print(operation)
\ No newline at end of file